@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import argparse
+import torch
+
+sys.path.insert(0, '..')
+from models.GCoNet_plus import GCoNet_plus
+from export import InferenceWrapper
+from dataset import get_loader
+from test import predict, predict_cascade, decoder_db_maps, image_confidence
+from util import PredictionWriter
+from config import Config
+from evaluation.dataloader import EvalDataset
+from evaluation.evaluator import Eval_thread
+
+
+def s_measure(saved_root, gt_root):
+    return Eval_thread(EvalDataset(saved_root, gt_root), cuda=False).Eval_Smeasure()
+
+
+def low_size_confidences(model, test_loader, low_size, apply_sigmoid):
+    # Per-image confidence of the first pass of predict_cascade, to pick the thresholds.
+    db_maps, handles = decoder_db_maps(model)
+    confidences = []
+    for batch in test_loader:
+        inputs_low = torch.nn.functional.interpolate(batch[0], size=(low_size, low_size), mode='bilinear', align_corners=True)
+        with torch.no_grad():
+            scaled_preds = model(inputs_low, batch[4])
+        confidences.append(image_confidence(scaled_preds, db_maps, apply_sigmoid))
+    for handle in handles:
+        handle.remove()
+    return torch.cat(confidences)
+
+
+def main(args):
+    config = Config()
+    model = GCoNet_plus(bb_pretrained=False)
+    model.load_state_dict(torch.load(args.ckpt, map_location='cpu'))
+    model = InferenceWrapper(model.eval())
+    apply_sigmoid = not (config.db_output_refiner or (not config.refine and config.db_output_decoder))
+    device = torch.device('cpu')
+
+    test_img_path = os.path.join(args.root_dir, 'images', args.testset)
+    test_gt_path = os.path.join(args.root_dir, 'gts', args.testset)
+    test_loader = get_loader(test_img_path, test_gt_path, args.size, 1, istrain=False, shuffle=False, num_workers=8, max_batch=args.max_batch)
+
+    writer = PredictionWriter()
+    saved_root = os.path.join(args.pred_dir, 'full', args.testset)
+    time_st = time.perf_counter()
+    predict(model, test_loader, saved_root, device, apply_sigmoid, writer)
+    writer.wait()
+    time_full = time.perf_counter() - time_st
+    s_measure_full = s_measure(saved_root, test_gt_path)
+    print('{} | full size {} | {:.1f} s | S-measure {:.4f}'.format(args.testset, args.size, time_full, s_measure_full))
+    quantiles = [0.1, 0.25, 0.5, 0.75, 0.9]
+    confidences = low_size_confidences(model, test_loader, args.low_size, apply_sigmoid)
+    print('{} | confidence at {} per image, quantiles {}: {}'.format(
+        args.testset, args.low_size, quantiles, ', '.join('{:.3f}'.format(value) for value in torch.quantile(confidences, torch.tensor(quantiles)).tolist())))
+    for level in args.levels.split(','):
+        for threshold in [float(threshold) for threshold in args.thresholds.split(',')]:
+            saved_root = os.path.join(args.pred_dir, '{}_{}_{}'.format(args.low_size, level, threshold), args.testset)
+            time_st = time.perf_counter()
+            early_exits = predict_cascade(model, test_loader, saved_root, device, apply_sigmoid, writer, args.low_size, threshold, per_image=level == 'image')
+            writer.wait()
+            time_cascade = time.perf_counter() - time_st
+            s_measure_cascade = s_measure(saved_root, test_gt_path)
+            print('{} | cascade {} -> {}, {} threshold {} | {:.1f} s (x{:.2f}) | early exits {:.1%} | S-measure {:.4f} ({:+.4f})'.format(
+                args.testset, args.low_size, args.size, level, threshold, time_cascade, time_full / time_cascade,
+                early_exits, s_measure_cascade, s_measure_cascade - s_measure_full))
+    writer.close()
+
+
+if __name__ == '__main__':
+    # Latency/accuracy of the cascaded inference of test.py (--cascade_size) against the full size, on CPU.
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--ckpt', default='../ckpt/GCoNet_plus/final.pth', type=str, help='trained weights')
+    parser.add_argument('--testset', default='CoCA', type=str)
+    parser.add_argument('--root_dir', default='../../../datasets/sod', type=str, help='dataset root')
+    parser.add_argument('--pred_dir', default='/root/datasets/sod/preds/GCoNet_plus_cascade', type=str)
+    parser.add_argument('--max_batch', default=1, type=int, help='max number of images per forward pass')
+    parser.add_argument('--size', default=256, type=int, help='full input size')
+    parser.add_argument('--low_size', default=128, type=int, help='input size of the first pass')
+    parser.add_argument('--thresholds', default='0.1,0.2,0.3,0.4', type=str)
+    parser.add_argument('--levels', default='group,image', type=str)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,81 @@
+import sys
+import argparse
+import functools
+import torch
+
+sys.path.insert(0, '..')
+from models.GCoNet_plus import GCoNet_plus
+from utils import latency, peak_memory
+
+
+def flatten(values):
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            yield from flatten(value)
+        else:
+            yield value
+
+
+def build(checkpoint_stages, group_size, size, freeze):
+    torch.manual_seed(0)
+    model = GCoNet_plus(bb_pretrained=False).train()
+    model.config.checkpoint_stages = checkpoint_stages
+    if freeze:
+        # Same as Config.freeze in train.py.
+        for key, value in model.named_parameters():
+            if 'bb' in key and 'bb.conv5.conv5_3' not in key:
+                value.requires_grad = False
+    return model, torch.randn(group_size, 3, size, size)
+
+
+def setup_train_step(*setting):
+    model, inputs = build(*setting)
+
+    def train_step():
+        # Forward and backward of all the outputs of the training forward, as a stand-in for the losses.
+        loss = sum(value.float().mean() for value in flatten(model(inputs)))
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+    return train_step
+
+
+def saved_activations(*setting):
+    # MB kept by autograd for backward after the training forward, exact unlike the RSS on CPU.
+    model, inputs = build(*setting)
+    storages = {}
+
+    def pack(tensor):
+        storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        model(inputs)
+    return sum(storages.values()) / 1024 ** 2
+
+
+def main(args):
+    settings = [[stage for stage in setting.split('+') if stage] for setting in args.settings.split(',')]
+    print('checkpoint_stages | group_size | saved activations (MB) | peak memory (MB) | step (ms) | imgs/s')
+    for group_size in [int(group_size) for group_size in args.group_sizes.split(',')]:
+        for checkpoint_stages in settings:
+            setting = (checkpoint_stages, group_size, args.size, args.freeze)
+            # On CPU the peak RSS also depends on how the allocator reuses freed blocks during the recomputation,
+            # the saved activations are what checkpointing actually saves.
+            memory = peak_memory(functools.partial(setup_train_step, *setting), grad=True)
+            step_time = latency(setup_train_step(*setting), repeats=args.repeats, grad=True)
+            print('{:>25s} | {:10d} | {:22.1f} | {:16.1f} | {:9.1f} | {:6.2f}'.format(
+                '+'.join(checkpoint_stages) or 'none', group_size, saved_activations(*setting), memory, step_time * 1e3, group_size / step_time))
+
+
+if __name__ == '__main__':
+    # Memory/throughput of a training step with Config.checkpoint_stages, to find the largest group that fits.
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--settings', default=',bb,decoder,cls_mask,decoder+cls_mask,bb+decoder+refiner+cls_mask', type=str,
+                        help="comma-separated sets of checkpointed stages, '+' within a set, empty for none")
+    parser.add_argument('--group_sizes', default='8,16', type=str)
+    parser.add_argument('--size', default=224, type=int, help='input size')
+    parser.add_argument('--freeze', default=True, type=lambda value: value.lower() in ['1', 'true'],
+                        help='freeze the backbone like Config.freeze, which makes checkpointing it moot')
+    parser.add_argument('--repeats', default=2, type=int)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,72 @@
+import os
+import sys
+import copy
+import time
+import argparse
+import torch
+
+sys.path.insert(0, '..')
+from models.GCoNet_plus import GCoNet_plus
+from models.fusion import fold_batchnorm
+from export import InferenceWrapper
+from dataset import get_loader
+
+
+def build_variant(model, variant):
+    # variant: '+'-separated options among 'fuse', 'channels_last', 'ipex', e.g. 'fuse+channels_last'.
+    options = variant.split('+')
+    model = copy.deepcopy(model)
+    if 'fuse' in options:
+        model = fold_batchnorm(model)
+    if 'channels_last' in options:
+        model = model.to(memory_format=torch.channels_last)
+    if 'ipex' in options:
+        import intel_extension_for_pytorch as ipex
+        model = ipex.optimize(model)
+    return InferenceWrapper(model, channels_last='channels_last' in options)
+
+
+def main(args):
+    model = GCoNet_plus(bb_pretrained=False)
+    if args.ckpt:
+        model.load_state_dict(torch.load(args.ckpt, map_location='cpu'))
+    model.eval()
+
+    print('testset | threads | variant | imgs/s')
+    for testset in args.testsets.split('+'):
+        test_loader = get_loader(
+            os.path.join(args.root_dir, 'images', testset), os.path.join(args.root_dir, 'gts', testset),
+            args.size, 1, istrain=False, shuffle=False, num_workers=4, max_batch=args.max_batch)
+        # The groups are loaded once, only the forward passes are timed.
+        batches = [(batch[0], batch[4]) for _, batch in zip(range(args.max_groups), test_loader)]
+        num_images = sum(inputs.shape[0] for inputs, _ in batches)
+        for threads in [int(threads) for threads in args.threads.split(',')]:
+            torch.set_num_threads(threads)
+            for variant in args.variants.split(','):
+                try:
+                    wrapper = build_variant(model, variant)
+                except ImportError as e:
+                    print('{} | {:7d} | {} | skipped ({})'.format(testset, threads, variant, e))
+                    continue
+                with torch.no_grad():
+                    wrapper(*batches[0])
+                    time_st = time.perf_counter()
+                    for inputs, group_idx in batches:
+                        wrapper(inputs, group_idx)
+                print('{} | {:7d} | {} | {:.2f}'.format(testset, threads, variant, num_images / (time.perf_counter() - time_st)))
+
+
+if __name__ == '__main__':
+    # CPU throughput of the inference modes of test.py (--fuse, --channels_last, --ipex, --threads) on the test sets.
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--ckpt', default='', type=str, help='trained weights, random ones if empty (same speed)')
+    parser.add_argument('--testsets', default='CoCA+CoSOD3k+CoSal2015', type=str)
+    parser.add_argument('--root_dir', default='../../../datasets/sod', type=str, help='dataset root')
+    parser.add_argument('--size', default=256, type=int, help='input size')
+    parser.add_argument('--max_batch', default=1, type=int, help='max number of images per forward pass')
+    parser.add_argument('--max_groups', default=10, type=int, help='number of batches timed per test set')
+    parser.add_argument('--threads', default=str(torch.get_num_threads()), type=str, help='comma-separated thread counts')
+    parser.add_argument('--variants', default='default,channels_last,fuse,fuse+channels_last,fuse+channels_last+ipex', type=str)
+    args = parser.parse_args()
+
+    main(args)
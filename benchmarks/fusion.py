@@ -0,0 +1,59 @@
+import sys
+import copy
+import argparse
+import torch
+
+sys.path.insert(0, '..')
+from models.GCoNet_plus import GCoNet_plus
+from models.fusion import fold_batchnorm
+from utils import latency
+
+
+def relu_share(model, inputs):
+    # Fraction of the CPU time of a forward spent in the in-place ReLUs (aten::relu_ runs clamp_min_), the most a conv+ReLU fusion could save.
+    with torch.no_grad():
+        model(inputs)
+        with torch.profiler.profile() as profiler:
+            model(inputs)
+    events = profiler.key_averages()
+    return sum(event.self_cpu_time_total for event in events if event.key in ('aten::relu_', 'aten::clamp_min_')) / sum(event.self_cpu_time_total for event in events)
+
+
+def main(args):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    model = GCoNet_plus(bb_pretrained=False)
+    if args.ckpt:
+        model.load_state_dict(torch.load(args.ckpt, map_location='cpu'))
+    else:
+        # Without trained weights, random BN statistics make the folding non-trivial.
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.1, 0.1)
+                module.running_var.uniform_(0.5, 1.5)
+    model.eval()
+    model_fused = fold_batchnorm(copy.deepcopy(model))
+
+    print('group_size | max abs diff | unfused (ms) | fused (ms) | speedup | ReLU share (fused)')
+    for group_size in [int(group_size) for group_size in args.group_sizes.split(',')]:
+        inputs = torch.randn(group_size, 3, args.size, args.size)
+        with torch.no_grad():
+            max_diff = (model(inputs)[-1] - model_fused(inputs)[-1]).abs().max().item()
+        assert max_diff < args.atol, 'Folded model deviates by {:.2e} with group size {}.'.format(max_diff, group_size)
+        latency_unfused = latency(lambda: model(inputs), repeats=args.repeats)
+        latency_fused = latency(lambda: model_fused(inputs), repeats=args.repeats)
+        print('{:10d} | {:12.2e} | {:12.1f} | {:10.1f} | x{:.2f} | {:18.1%}'.format(
+            group_size, max_diff, latency_unfused * 1e3, latency_fused * 1e3, latency_unfused / latency_fused, relu_share(model_fused, inputs)))
+
+
+if __name__ == '__main__':
+    # Numerical equivalence, CPU latency and remaining ReLU cost of models.fusion.fold_batchnorm, as used by test.py --fuse.
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--ckpt', default='', type=str, help='trained weights, random ones if not given')
+    parser.add_argument('--size', default=224, type=int, help='input size')
+    parser.add_argument('--group_sizes', default='1,8,16', type=str)
+    parser.add_argument('--repeats', default=5, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='CPU threads, 0 for the torch default')
+    parser.add_argument('--atol', default=1e-4, type=float, help='max allowed abs deviation of the folded model')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,83 @@
+import os
+import sys
+import argparse
+import torch
+
+sys.path.insert(0, '..')
+from models.GCoNet_plus import GCoNet_plus
+from models.modules import GAM
+from export import InferenceWrapper
+from dataset import get_loader
+from test import evaluate
+from config import Config
+from utils import latency
+
+
+def set_gam_mode(gam, approx, num_reps, chunk_size):
+    gam.approx, gam.num_reps, gam.chunk_size = approx, num_reps, chunk_size
+
+
+def main(args):
+    config = Config()
+    settings = [(approx, int(num_reps)) for approx in args.approx.split(',') for num_reps in args.num_reps.split(',')]
+
+    model = None
+    if args.ckpt:
+        model = GCoNet_plus(bb_pretrained=False)
+        model.load_state_dict(torch.load(args.ckpt, map_location='cpu'))
+        model.eval()
+    # GAM of the trained model if given, a random one otherwise.
+    gam = model.co_x5.all_attention if model is not None else GAM(512).eval()
+    assert isinstance(gam, GAM), 'Config.relation_module must be GAM.'
+
+    # Speed and drift of the GAM output on random x5 features of large groups.
+    print('group_size | approx | num_reps | latency (ms) | exact (ms) | rel. drift')
+    for group_size in [int(group_size) for group_size in args.group_sizes.split(',')]:
+        x5 = torch.randn(group_size, 512, args.size // 16, args.size // 16)
+        # The exact reference is chunked so that it fits in memory for large groups.
+        set_gam_mode(gam, None, 0, args.chunk_size)
+        latency_exact = latency(lambda: gam(x5), repeats=1, warmup=0)
+        with torch.no_grad():
+            x5_exact = gam(x5)
+        for approx, num_reps in settings:
+            set_gam_mode(gam, approx, num_reps, args.chunk_size)
+            latency_approx = latency(lambda: gam(x5), repeats=1, warmup=0)
+            with torch.no_grad():
+                drift = ((gam(x5) - x5_exact).norm() / x5_exact.norm()).item()
+            print('{:10d} | {:>6s} | {:8d} | {:12.1f} | {:10.1f} | {:10.4f}'.format(
+                group_size, approx, num_reps, latency_approx * 1e3, latency_exact * 1e3, drift))
+
+    # S-measure drift on a real test set.
+    if model is None or not args.testset:
+        return
+    test_img_path = os.path.join(args.root_dir, 'images', args.testset)
+    test_gt_path = os.path.join(args.root_dir, 'gts', args.testset)
+    test_loader = get_loader(test_img_path, test_gt_path, args.size, 1, istrain=False, shuffle=False, num_workers=8, max_batch=args.max_batch)
+    apply_sigmoid = not (config.db_output_refiner or (not config.refine and config.db_output_decoder))
+
+    set_gam_mode(gam, None, 0, args.chunk_size)
+    s_measure_exact, _ = evaluate(InferenceWrapper(model), test_loader, os.path.join(args.pred_dir, 'exact', args.testset), test_gt_path, apply_sigmoid)
+    print('{} | exact GAM | S-measure {:.4f}'.format(args.testset, s_measure_exact))
+    for approx, num_reps in settings:
+        set_gam_mode(gam, approx, num_reps, args.chunk_size)
+        saved_root = os.path.join(args.pred_dir, '{}_{}'.format(approx, num_reps), args.testset)
+        s_measure, _ = evaluate(InferenceWrapper(model), test_loader, saved_root, test_gt_path, apply_sigmoid)
+        print('{} | {} x {} | S-measure {:.4f} ({:+.4f})'.format(args.testset, approx, num_reps, s_measure, s_measure - s_measure_exact))
+
+
+if __name__ == '__main__':
+    # Accuracy/speed of the approximate GAM (Config.gam_approx, Config.gam_num_reps) against the exact one.
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--ckpt', default='', type=str, help='trained weights, needed for the S-measure part')
+    parser.add_argument('--testset', default='', type=str, help="e.g. 'CoCA', S-measure drift is skipped if empty")
+    parser.add_argument('--root_dir', default='../../../datasets/sod', type=str, help='dataset root')
+    parser.add_argument('--pred_dir', default='/root/datasets/sod/preds/GCoNet_plus_gam_approx', type=str)
+    parser.add_argument('--max_batch', default=256, type=int, help='pack test groups up to this many images')
+    parser.add_argument('--size', default=224, type=int, help='input size, x5 is 1/16 of it')
+    parser.add_argument('--approx', default='random,kmeans,pool', type=str)
+    parser.add_argument('--num_reps', default='4,16,64', type=str, help='representatives per image')
+    parser.add_argument('--group_sizes', default='64,256,512', type=str)
+    parser.add_argument('--chunk_size', default=4096, type=int, help='tile size of the exact reference')
+    args = parser.parse_args()
+
+    main(args)
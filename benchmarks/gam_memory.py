@@ -0,0 +1,56 @@
+import sys
+import argparse
+import functools
+import torch
+
+sys.path.insert(0, '..')
+from models.modules import GAM
+from utils import latency, peak_memory
+
+
+def setup_gam(group_size, size, chunk_size, channel_in=512):
+    torch.manual_seed(0)
+    gam = GAM(channel_in).eval()
+    gam.chunk_size = chunk_size
+    # x5 of the vgg16(bn) backbone is at 1/16 of the input size.
+    x5 = torch.randn(group_size, channel_in, size // 16, size // 16)
+    return lambda: gam(x5)
+
+
+def main(args):
+    group_sizes = [int(group_size) for group_size in args.group_sizes.split(',')]
+    sizes = [int(size) for size in args.sizes.split(',')]
+    print('group_size | size | full matrix (MB) | peak full (MB) | peak chunked (MB) | full (ms) | chunked (ms) | bit-exact')
+    for size in sizes:
+        for group_size in group_sizes:
+            full_mb = (group_size * (size // 16) ** 2) ** 2 * 4 / 1024 ** 2
+            setup_full = functools.partial(setup_gam, group_size, size, 0)
+            setup_chunked = functools.partial(setup_gam, group_size, size, args.chunk_size)
+            peak_chunked = peak_memory(setup_chunked)
+            run_chunked = setup_chunked()
+            latency_chunked = latency(run_chunked, repeats=args.repeats)
+            if full_mb > args.max_full_mb:
+                # The full affinity matrix does not fit the budget, only the chunked one runs.
+                print('{:10d} | {:4d} | {:16.1f} | {:>14s} | {:17.1f} | {:>9s} | {:12.1f} | {:>9s}'.format(
+                    group_size, size, full_mb, 'skipped', peak_chunked, '-', latency_chunked * 1e3, '-'))
+                continue
+            peak_full = peak_memory(setup_full)
+            run_full = setup_full()
+            latency_full = latency(run_full, repeats=args.repeats)
+            with torch.no_grad():
+                bit_exact = torch.equal(run_full(), run_chunked())
+            print('{:10d} | {:4d} | {:16.1f} | {:14.1f} | {:17.1f} | {:9.1f} | {:12.1f} | {:>9s}'.format(
+                group_size, size, full_mb, peak_full, peak_chunked, latency_full * 1e3, latency_chunked * 1e3, str(bit_exact)))
+
+
+if __name__ == '__main__':
+    # Peak memory, latency and parity of the full vs the chunked GAM affinity (Config.gam_chunk_size).
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--group_sizes', default='8,16,32,64,128,256', type=str)
+    parser.add_argument('--sizes', default='224,256,384,512', type=str, help='input sizes, x5 is 1/16 of them')
+    parser.add_argument('--chunk_size', default=4096, type=int, help='query positions per tile')
+    parser.add_argument('--max_full_mb', default=8192, type=float, help='skip the full version when its affinity matrix is larger')
+    parser.add_argument('--repeats', default=2, type=int)
+    args = parser.parse_args()
+
+    main(args)
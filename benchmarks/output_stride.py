@@ -0,0 +1,69 @@
+import os
+import sys
+import argparse
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, '..')
+from models.GCoNet_plus import GCoNet_plus
+from export import InferenceWrapper
+from dataset import get_loader
+from test import evaluate
+from config import Config
+from utils import latency
+
+
+def set_output_stride(model, output_stride, guided):
+    model.config.output_stride, model.config.output_guided = output_stride, guided
+
+
+def main(args):
+    config = Config()
+    model = GCoNet_plus(bb_pretrained=False)
+    if args.ckpt:
+        model.load_state_dict(torch.load(args.ckpt, map_location='cpu'))
+    model.eval()
+    settings = [(int(output_stride), guided) for output_stride in args.output_strides.split(',') for guided in [False, True] if int(output_stride) > 1 or not guided]
+
+    # Latency and drift of the final prediction, upsampled to the input size like test.py does, against output_stride 1.
+    inputs = torch.randn(args.group_size, 3, args.size, args.size)
+    set_output_stride(model, 1, False)
+    with torch.no_grad():
+        preds_ref = model(inputs)[-1]
+    print('output_stride | guided | latency (ms) | mean abs diff')
+    for output_stride, guided in settings:
+        set_output_stride(model, output_stride, guided)
+        with torch.no_grad():
+            preds = F.interpolate(model(inputs)[-1], size=preds_ref.shape[2:], mode='bilinear', align_corners=True)
+        print('{:13d} | {:>6s} | {:12.1f} | {:13.4f}'.format(
+            output_stride, str(guided), latency(lambda: model(inputs), repeats=args.repeats) * 1e3, (preds - preds_ref).abs().mean().item()))
+
+    # S-measure/E-max on a real test set.
+    if not args.ckpt or not args.testset:
+        return
+    test_img_path = os.path.join(args.root_dir, 'images', args.testset)
+    test_gt_path = os.path.join(args.root_dir, 'gts', args.testset)
+    test_loader = get_loader(test_img_path, test_gt_path, args.size, 1, istrain=False, shuffle=False, num_workers=8, max_batch=args.max_batch)
+    apply_sigmoid = not (config.db_output_refiner or (not config.refine and config.db_output_decoder))
+    for output_stride, guided in settings:
+        set_output_stride(model, output_stride, guided)
+        saved_root = os.path.join(args.pred_dir, 'os{}{}'.format(output_stride, '_guided' if guided else ''), args.testset)
+        s_measure, e_max = evaluate(InferenceWrapper(model), test_loader, saved_root, test_gt_path, apply_sigmoid)
+        print('{} | output_stride {}{} | S-measure {:.4f} | E-max {:.4f}'.format(args.testset, output_stride, ', guided' if guided else '', s_measure, e_max))
+
+
+if __name__ == '__main__':
+    # Latency/accuracy of running the output head at lower resolution (Config.output_stride, Config.output_guided).
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--ckpt', default='', type=str, help='trained weights, needed for the S-measure part')
+    parser.add_argument('--testset', default='', type=str, help="e.g. 'CoCA', S-measure is skipped if empty")
+    parser.add_argument('--root_dir', default='../../../datasets/sod', type=str, help='dataset root')
+    parser.add_argument('--pred_dir', default='/root/datasets/sod/preds/GCoNet_plus_output_stride', type=str)
+    parser.add_argument('--max_batch', default=1, type=int, help='max number of images per forward pass')
+    parser.add_argument('--output_strides', default='1,2,4', type=str)
+    parser.add_argument('--size', default=224, type=int, help='input size')
+    parser.add_argument('--group_size', default=8, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,110 @@
+import sys
+import json
+import argparse
+import functools
+import torch
+from fvcore.nn import FlopCountAnalysis
+
+sys.path.insert(0, '..')
+from models.modules import GAM, ICE, NonLocal, MHA, CoAttLayer
+from utils import latency, peak_memory
+
+
+relation_modules = {'GAM': GAM, 'ICE': ICE, 'NonLocal': NonLocal, 'MHA': MHA}
+
+
+def build(name, fused, layer, group_size, resolution, channel_in, dtype):
+    # The relation module alone, or a whole CoAttLayer around it.
+    torch.manual_seed(0)
+    # MHA has its own d_model (512 like x5 of the backbones), tie it to the swept width.
+    module = relation_modules[name](channel_in=channel_in, **({'d_model': channel_in} if name == 'MHA' else {}))
+    if hasattr(module, 'fused'):
+        module.fused = fused
+    if layer == 'CoAttLayer':
+        # CoAttLayer picks its module from Config.relation_module, swap in the one to measure.
+        co_att = CoAttLayer(channel_in=channel_in)
+        co_att.all_attention = module
+        module = co_att
+    module = module.eval().to(getattr(torch, dtype))
+    x5 = torch.randn(group_size, channel_in, resolution, resolution, dtype=getattr(torch, dtype))
+    return module, x5
+
+
+def setup_forward(*setting):
+    module, x5 = build(*setting)
+    return lambda: module(x5)
+
+
+def sdpa_flop_jit(inputs, outputs):
+    # fvcore has no handle for scaled_dot_product_attention: q @ k^T and attn @ v, one flop per multiply-add.
+    q_shape, k_shape, v_shape = [list(ipt.type().sizes()) for ipt in inputs[:3]]
+    batch = 1
+    for size in q_shape[:-2]:
+        batch *= size
+    return batch * q_shape[-2] * k_shape[-2] * (q_shape[-1] + v_shape[-1])
+
+
+def count_flops(*setting):
+    module, x5 = build(*setting)
+    flops = FlopCountAnalysis(module, (x5, )).set_op_handle('aten::scaled_dot_product_attention', sdpa_flop_jit)
+    flops.unsupported_ops_warnings(False).uncalled_modules_warnings(False)
+    return flops.total()
+
+
+def sweep(args):
+    split = lambda values, cast=str: [cast(value) for value in values.split(',')]
+    for layer in split(args.layers):
+        for dtype in split(args.dtypes):
+            for channel_in in split(args.channels, int):
+                for resolution in split(args.resolutions, int):
+                    for group_size in split(args.group_sizes, int):
+                        for name in split(args.modules):
+                            # Fused attention only exists in MHA and NonLocal, compare both paths there.
+                            for fused in ([True, False] if name in ['MHA', 'NonLocal'] else [None]):
+                                yield name, fused, layer, group_size, resolution, channel_in, dtype
+
+
+def main(args):
+    records = []
+    print('layer | module | fused | dtype | channels | group_size | resolution | latency (ms) | peak memory (MB) | GFLOPs')
+    for setting in sweep(args):
+        name, fused, layer, group_size, resolution, channel_in, dtype = setting
+        record = {
+            'layer': layer, 'module': name, 'fused': fused, 'dtype': dtype,
+            'channels': channel_in, 'group_size': group_size, 'resolution': resolution,
+        }
+        try:
+            record['latency_ms'] = latency(setup_forward(*setting), repeats=args.repeats) * 1e3
+            record['peak_memory_mb'] = peak_memory(functools.partial(setup_forward, *setting)) if args.memory else None
+            with torch.no_grad():
+                record['gflops'] = count_flops(*setting) / 1e9
+        except RuntimeError as e:
+            # e.g. out of memory or an op without a kernel for this dtype.
+            record['error'] = str(e).split('\n')[0]
+        records.append(record)
+        print('{:>10s} | {:>8s} | {:>5s} | {:>8s} | {:8d} | {:10d} | {:10d} | {} | {} | {}'.format(
+            layer, name, '-' if fused is None else str(fused), dtype, channel_in, group_size, resolution,
+            *['{:.1f}'.format(record[key]) if record.get(key) is not None else record.get('error', '-')[:20]
+              for key in ['latency_ms', 'peak_memory_mb', 'gflops']]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'torch': torch.__version__, 'num_threads': torch.get_num_threads(), 'records': records}, f, indent=2)
+        print('Saved {} records to {}.'.format(len(records), args.output))
+
+
+if __name__ == '__main__':
+    # Cost of the relation modules (Config.relation_module), alone and inside CoAttLayer, on CPU.
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--modules', default='GAM,ICE,NonLocal,MHA', type=str)
+    parser.add_argument('--layers', default='module,CoAttLayer', type=str, help="'module': the relation module alone")
+    parser.add_argument('--group_sizes', default='8,32', type=str)
+    parser.add_argument('--resolutions', default='14,32,64', type=str, help='x5 resolution, 1/16 of the input size')
+    parser.add_argument('--channels', default='512', type=str)
+    parser.add_argument('--dtypes', default='float32,bfloat16', type=str)
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--memory', default=True, type=lambda value: value.lower() in ['1', 'true'], help='measure peak memory, one process per setting')
+    parser.add_argument('--output', default='relation_modules.json', type=str, help='JSON report, skipped if empty')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,55 @@
+import sys
+import argparse
+import torch
+from torch import nn
+
+sys.path.insert(0, '..')
+from loss import SaliencyLoss
+from tests.references import criterions_loop, saliency_inputs, parity
+from utils import latency
+
+
+def setup_step(criterion, group_size, size, levels):
+    preds, gt = saliency_inputs(group_size, size, levels)
+
+    def step():
+        loss = 0
+        for pred in preds:
+            pred_lvl = nn.functional.interpolate(pred, size=gt.shape[2:], mode='bilinear', align_corners=True).sigmoid()
+            loss += criterion(pred_lvl, gt)
+        loss.backward()
+        for pred in preds:
+            pred.grad = None
+        return loss
+    return step
+
+
+def main(args):
+    lambdas_settings = {
+        # Config.lambdas_sal_last by default, and every criterion on.
+        'bce+iou': {'bce': 30, 'iou': 0.5, 'ssim': 0, 'mse': 0, 'reg': 0},
+        'all': {'bce': 30, 'iou': 0.5, 'ssim': 1, 'mse': 150, 'reg': 100},
+    }
+    print('lambdas | group_size | loop (ms) | fused (ms) | speedup | loss diff | max grad diff')
+    for name in args.lambdas.split(','):
+        lambdas = lambdas_settings[name]
+        for group_size in [int(group_size) for group_size in args.group_sizes.split(',')]:
+            setting = (group_size, args.size, args.levels)
+            time_loop = latency(setup_step(criterions_loop(lambdas), *setting), repeats=args.repeats, grad=True)
+            time_fused = latency(setup_step(SaliencyLoss(lambdas), *setting), repeats=args.repeats, grad=True)
+            loss_diff, grad_diff = parity(lambdas, *setting)
+            print('{:>7s} | {:10d} | {:9.1f} | {:10.1f} | {:7.2f} | {:9.2e} | {:13.2e}'.format(
+                name, group_size, time_loop * 1e3, time_fused * 1e3, time_loop / time_fused, loss_diff, grad_diff))
+
+
+if __name__ == '__main__':
+    # Forward + backward time of the saliency losses of DSLoss per training step, per-criterion loop vs SaliencyLoss.
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--lambdas', default='bce+iou,all', type=str)
+    parser.add_argument('--group_sizes', default='8,16,32', type=str)
+    parser.add_argument('--size', default=256, type=int, help='input size')
+    parser.add_argument('--levels', default=5, type=int, help='number of supervised outputs')
+    parser.add_argument('--repeats', default=5, type=int)
+    args = parser.parse_args()
+
+    main(args)
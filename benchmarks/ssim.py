@@ -0,0 +1,91 @@
+import sys
+import argparse
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+sys.path.insert(0, '..')
+from loss import gaussian, SSIMLoss, saliency_structure_consistency
+from utils import latency
+
+
+def ssim_loss_2d(img1, img2, window_size=11):
+    # The former SSIMLoss, five full 2D Gaussian convs, kept as the reference for the parity check.
+    channel = img1.shape[1]
+    window_1d = gaussian(window_size, 1.5).unsqueeze(1)
+    window = window_1d.mm(window_1d.t()).expand(channel, 1, window_size, window_size).contiguous().to(img1)
+    conv = lambda img: F.conv2d(img, window, padding=window_size//2, groups=channel)
+    mu1, mu2 = conv(img1), conv(img2)
+    sigma1_sq = conv(img1*img1) - mu1.pow(2)
+    sigma2_sq = conv(img2*img2) - mu2.pow(2)
+    sigma12 = conv(img1*img2) - mu1*mu2
+    C1, C2 = 0.01**2, 0.03**2
+    ssim_map = ((2*mu1*mu2 + C1)*(2*sigma12 + C2))/((mu1.pow(2) + mu2.pow(2) + C1)*(sigma1_sq + sigma2_sq + C2))
+    return 1 - ssim_map.mean()
+
+
+def structure_consistency_pools(x, y):
+    # The former saliency_structure_consistency, new nn.AvgPool2d modules per moment.
+    C1, C2 = 0.01 ** 2, 0.03 ** 2
+    mu_x, mu_y = nn.AvgPool2d(3, 1, 1)(x), nn.AvgPool2d(3, 1, 1)(y)
+    sigma_x = nn.AvgPool2d(3, 1, 1)(x * x) - mu_x.pow(2)
+    sigma_y = nn.AvgPool2d(3, 1, 1)(y * y) - mu_y.pow(2)
+    sigma_xy = nn.AvgPool2d(3, 1, 1)(x * y) - mu_x * mu_y
+    SSIM = ((2 * mu_x * mu_y + C1) * (2 * sigma_xy + C2)) / ((mu_x.pow(2) + mu_y.pow(2) + C1) * (sigma_x + sigma_y + C2))
+    return torch.mean(torch.clamp((1 - SSIM) / 2, 0, 1))
+
+
+def setup_step(fn, group_size, size, grad, device):
+    torch.manual_seed(0)
+    x = torch.rand(group_size, 1, size, size, device=device, requires_grad=grad)
+    y = (torch.rand(group_size, 1, size, size, device=device) > 0.5).float()
+
+    def step():
+        loss = fn(x, y)
+        if grad:
+            loss.backward()
+            x.grad = None
+        return loss
+    return step
+
+
+def max_diff(fn_ref, fn, group_size, size, device):
+    torch.manual_seed(0)
+    x = torch.rand(group_size, 1, size, size, device=device)
+    y = (torch.rand(group_size, 1, size, size, device=device) > 0.5).float()
+    return max((torch.as_tensor(ref) - torch.as_tensor(value)).abs().max().item() for ref, value in zip(*[
+        (lambda values: values if isinstance(values, (list, tuple)) else [values])(fn(x, y)) for fn in [fn_ref, fn]]))
+
+
+def main(args):
+    device = torch.device(args.device)
+    separable = SSIMLoss()
+    separable.engine.band_limit = 0
+    cases = {
+        # name: (reference, engine, with backward)
+        'SSIMLoss': (ssim_loss_2d, SSIMLoss(), True),
+        # The grouped separable convs only, what the engine runs off CPU.
+        'SSIMLoss_separable': (ssim_loss_2d, separable, True),
+        'structure_consistency': (structure_consistency_pools, saliency_structure_consistency, True),
+    }
+    print('case | group_size | reference (ms) | engine (ms) | speedup | max diff')
+    for name in args.cases.split(','):
+        fn_ref, fn, grad = cases[name]
+        for group_size in [int(group_size) for group_size in args.group_sizes.split(',')]:
+            time_ref = latency(setup_step(fn_ref, group_size, args.size, grad, device), repeats=args.repeats, device=device, grad=grad)
+            time_engine = latency(setup_step(fn, group_size, args.size, grad, device), repeats=args.repeats, device=device, grad=grad)
+            print('{:>21s} | {:10d} | {:14.2f} | {:11.2f} | {:7.2f} | {:8.2e}'.format(
+                name, group_size, time_ref * 1e3, time_engine * 1e3, time_ref / time_engine, max_diff(fn_ref, fn, group_size, args.size, device)))
+
+
+if __name__ == '__main__':
+    # SSIMEngine (separable Gaussian, batched moments) against the former per-moment SSIM code, forward + backward.
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--cases', default='SSIMLoss,SSIMLoss_separable,structure_consistency', type=str)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--group_sizes', default='8,32', type=str)
+    parser.add_argument('--size', default=256, type=int)
+    parser.add_argument('--repeats', default=5, type=int)
+    args = parser.parse_args()
+
+    main(args)
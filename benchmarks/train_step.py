@@ -0,0 +1,215 @@
+import sys
+import json
+import time
+import resource
+import argparse
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils import data
+
+sys.path.insert(0, '..')
+import config as config_module
+
+
+# Config variants, the overrides are set on every Config() of the process (model, modules, DSLoss).
+# Derived Config fields (use_bn, the triplet lambda, split_mask) are overridden along with the field they follow.
+variants = OrderedDict([
+    ('default', {}),
+    ('bb=vgg16', {'bb': 'vgg16', 'use_bn': False}),
+    ('bb=resnet50', {'bb': 'resnet50', 'use_bn': True}),
+    ('relation=ICE', {'relation_module': 'ICE'}),
+    ('relation=NonLocal', {'relation_module': 'NonLocal'}),
+    ('relation=MHA', {'relation_module': 'MHA'}),
+    ('refine=1', {'refine': 1}),
+    ('refine=4', {'refine': 4}),
+    ('loss=sal', {'loss': ['sal'], 'lambdas_sal_last': {'triplet': 0}, 'split_mask': False}),
+    ('loss=sal+cls', {'loss': ['sal', 'cls']}),
+    ('loss=sal+contrast', {'loss': ['sal', 'contrast'], 'lambdas_sal_last': {'triplet': 0}, 'split_mask': False}),
+    ('loss=sal+cls+cls_mask', {'loss': ['sal', 'cls', 'cls_mask']}),
+])
+
+
+def apply_overrides(overrides):
+    init = config_module.Config.__init__
+
+    def __init__(self):
+        init(self)
+        for key, value in overrides.items():
+            if isinstance(value, dict):
+                getattr(self, key).update(value)
+            else:
+                setattr(self, key, value)
+    config_module.Config.__init__ = __init__
+
+
+class SyntheticGroups(data.Dataset):
+    """
+    Random training items shaped like those of CoData: group_size images of one class and group_size of another,
+    blob-like masks and the class labels. Generated in memory from the item index, no dataset needed.
+    """
+    def __init__(self, num_groups, group_size, size, num_classes=291):
+        self.num_groups = num_groups
+        self.group_size = group_size
+        self.size = size
+        self.num_classes = num_classes
+
+    def __getitem__(self, item):
+        generator = torch.Generator().manual_seed(item)
+        num = 2 * self.group_size
+        images = torch.randn(num, 3, self.size, self.size, generator=generator)
+        # Smooth random fields thresholded to object-like masks.
+        noise = torch.rand(num, 1, self.size // 16, self.size // 16, generator=generator)
+        labels = (F.interpolate(noise, size=(self.size, self.size), mode='bilinear', align_corners=True) > 0.5).float()
+        cls_ls = [item % self.num_classes] * self.group_size + [(item + 1) % self.num_classes] * self.group_size
+        return images, labels, [], [], cls_ls
+
+    def __len__(self):
+        return self.num_groups
+
+
+def build(args):
+    # Same model, optimizer and freezing as train.py.
+    from models.GCoNet_plus import GCoNet_plus
+    from loss import DSLoss
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    model = GCoNet_plus(bb_pretrained=False).to(device).train()
+    config = model.config
+    backbone_params = list(map(id, model.bb.parameters()))
+    base_params = filter(lambda p: id(p) not in backbone_params, model.parameters())
+    optimizer = torch.optim.Adam(
+        params=[{'params': base_params}, {'params': model.bb.parameters(), 'lr': config.lr * 0.01}], lr=config.lr, betas=[0.9, 0.99]
+    )
+    if config.freeze:
+        for key, value in model.named_parameters():
+            if 'bb' in key and 'bb.conv5.conv5_3' not in key:
+                value.requires_grad = False
+    return model, DSLoss(), optimizer
+
+
+def compute_loss(model, dsloss, focal_loss, return_values, gts, cls_gts):
+    # The loss of one half of a train.py iteration (without label smoothing, self supervision and adv).
+    config = model.config
+    outputs = dict(zip(model.train_outputs, return_values))
+    scaled_preds = outputs['sal'][-min(config.loss_sal_layers+int(bool(config.refine)), 4+int(bool(config.refine))):]
+    if config.lambdas_sal_last['triplet']:
+        loss = dsloss(scaled_preds, gts, norm_features=return_values[-1], labels=cls_gts)[0]
+    else:
+        loss = dsloss(scaled_preds, gts)
+    if 'cls' in outputs:
+        loss += F.cross_entropy(outputs['cls'], cls_gts) * config.lambda_cls
+    if 'contrast' in outputs:
+        loss += focal_loss(outputs['contrast'], torch.cat([gts, torch.zeros_like(gts)], dim=0)) * config.lambda_contrast
+    if 'cls_mask' in outputs:
+        for pred_cls_mask in outputs['cls_mask']:
+            loss += F.cross_entropy(pred_cls_mask, cls_gts) * config.lambda_cls_mask
+    return loss
+
+
+def run_variant(name, args, queue):
+    try:
+        queue.put(benchmark_variant(name, args))
+    except Exception as e:
+        queue.put({'error': '{}: {}'.format(type(e).__name__, str(e).split('\n')[0])})
+
+
+def benchmark_variant(name, args):
+    apply_overrides(variants[name])
+    import pytorch_toolbelt.losses as PTL
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    device = torch.device(args.device)
+    model, dsloss, optimizer = build(args)
+    focal_loss = PTL.BinaryFocalLoss()
+    # Like train.py, each iteration is one group pair of DUTS_class and one of coco-seg, two forwards and one backward.
+    loaders = [
+        data.DataLoader(SyntheticGroups(args.warmup + args.steps, args.group_size, args.size), batch_size=1, num_workers=args.num_workers)
+        for _ in range(2)
+    ]
+
+    def synchronize():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    data_times, step_times, num_images = [], [], 0
+    iterators = [iter(loader) for loader in loaders]
+    for step in range(args.warmup + args.steps):
+        time_st = time.perf_counter()
+        batches = [next(iterator) for iterator in iterators]
+        time_data = time.perf_counter()
+        loss = 0
+        for batch in batches:
+            inputs = batch[0].to(device).squeeze(0)
+            gts = batch[1].to(device).squeeze(0)
+            cls_gts = torch.LongTensor(batch[-1]).to(device)
+            loss += compute_loss(model, dsloss, focal_loss, model(inputs), gts, cls_gts)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        synchronize()
+        if step >= args.warmup:
+            data_times.append(time_data - time_st)
+            step_times.append(time.perf_counter() - time_st)
+            num_images += sum(batch[0].shape[1] for batch in batches)
+    # Whole training state included (model, optimizer, activations), on CPU the max RSS of this process.
+    if device.type == 'cuda':
+        peak_memory = torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    else:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    step_times = np.array(step_times)
+    return {
+        'imgs_per_s': num_images / step_times.sum(),
+        'step_ms_p50': np.percentile(step_times, 50) * 1e3,
+        'step_ms_p90': np.percentile(step_times, 90) * 1e3,
+        'step_ms_p99': np.percentile(step_times, 99) * 1e3,
+        'data_fraction': sum(data_times) / step_times.sum(),
+        'peak_memory_mb': peak_memory,
+    }
+
+
+def main(args):
+    records = []
+    print('variant | imgs/s | step p50 (ms) | p90 (ms) | p99 (ms) | data % | peak memory (MB)')
+    for name in args.variants.split(','):
+        # One process per variant: the Config overrides stay in it, and its peak memory is its own.
+        ctx = multiprocessing.get_context('spawn')
+        queue = ctx.Queue()
+        process = ctx.Process(target=run_variant, args=(name, args, queue))
+        process.start()
+        record = queue.get()
+        process.join()
+        record = dict(variant=name, **record)
+        records.append(record)
+        if 'error' in record:
+            print('{:>22s} | {}'.format(name, record['error'][:80]))
+        else:
+            print('{:>22s} | {:6.2f} | {:13.1f} | {:8.1f} | {:8.1f} | {:6.1f} | {:16.1f}'.format(
+                name, record['imgs_per_s'], record['step_ms_p50'], record['step_ms_p90'], record['step_ms_p99'],
+                record['data_fraction'] * 100, record['peak_memory_mb']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'torch': torch.__version__, 'device': args.device, 'num_threads': args.threads or torch.get_num_threads(),
+                       'group_size': args.group_size, 'size': args.size, 'records': records}, f, indent=2)
+        print('Saved {} records to {}.'.format(len(records), args.output))
+
+
+if __name__ == '__main__':
+    # Training step cost (GCoNet_plus + DSLoss + the cls/contrast/cls_mask losses) of the Config variants on synthetic groups.
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--variants', default=','.join(variants), type=str, help='comma-separated names of the variants above')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--group_size', default=8, type=int, help='images per group, a training item holds two groups')
+    parser.add_argument('--size', default=224, type=int, help='input size')
+    parser.add_argument('--steps', default=10, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--num_workers', default=2, type=int, help='DataLoader workers generating the synthetic groups')
+    parser.add_argument('--threads', default=0, type=int, help='number of CPU threads, PyTorch default if 0')
+    parser.add_argument('--output', default='train_step.json', type=str, help='JSON report, skipped if empty')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,45 @@
+import sys
+import argparse
+import torch
+
+sys.path.insert(0, '..')
+from loss import TripletSemiHardLoss
+from tests.references import triplet_semi_hard_loss_tiled, corpus
+from utils import latency
+
+
+def main(args):
+    num_same_loss, max_grad_diff = 0, 0.
+    for embeddings, labels, margin, has_ties in corpus(args.num_cases):
+        losses, grads = [], []
+        for loss_fn in [triplet_semi_hard_loss_tiled, TripletSemiHardLoss]:
+            embeddings_grad = embeddings.clone().requires_grad_()
+            loss = loss_fn(embeddings_grad, labels, margin=margin)
+            if loss.requires_grad and torch.isfinite(loss):
+                loss.backward()
+            losses.append(loss.detach())
+            grads.append(embeddings_grad.grad if embeddings_grad.grad is not None else torch.zeros_like(embeddings))
+        num_same_loss += int(torch.equal(losses[0], losses[1]) or bool(losses[0].isnan() and losses[1].isnan()))
+        # With tied distances, both pick one of the equally distant negatives, but not always the same one.
+        if not has_ties:
+            max_grad_diff = max(max_grad_diff, (grads[0] - grads[1]).abs().max().item())
+    print('Bit-identical losses on {}/{} cases, max gradient difference {:.2e} without tied distances.'.format(num_same_loss, args.num_cases, max_grad_diff))
+
+    print('group_size | tiled (ms) | sorted (ms) | speedup')
+    for batch_size in [int(batch_size) for batch_size in args.group_sizes.split(',')]:
+        embeddings = torch.nn.functional.normalize(torch.randn(batch_size, 512), dim=1)
+        labels = torch.arange(batch_size) * 2 // batch_size
+        latency_tiled = latency(lambda: triplet_semi_hard_loss_tiled(embeddings, labels), repeats=args.repeats)
+        latency_sorted = latency(lambda: TripletSemiHardLoss(embeddings, labels), repeats=args.repeats)
+        print('{:10d} | {:10.2f} | {:11.2f} | x{:.1f}'.format(batch_size, latency_tiled * 1e3, latency_sorted * 1e3, latency_tiled / latency_sorted))
+
+
+if __name__ == '__main__':
+    # Parity and speed of the sorted semi-hard mining of TripletSemiHardLoss against the former tiled one, on CPU.
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--num_cases', default=500, type=int, help='size of the random parity corpus')
+    parser.add_argument('--group_sizes', default='26,52,128,256', type=str, help='two groups of config.batch_size per step in train.py')
+    parser.add_argument('--repeats', default=10, type=int)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,59 @@
+import time
+import resource
+import multiprocessing
+import torch
+
+
+def latency(fn, repeats=5, warmup=1, device=torch.device('cpu'), grad=False):
+    # Average wall time of fn() in seconds, with autograd off unless grad (e.g. fn runs a training step).
+    with torch.set_grad_enabled(grad):
+        for _ in range(warmup):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        time_st = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.perf_counter() - time_st) / repeats
+
+
+def _current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024 ** 2
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _peak_rss_worker(setup, grad, queue):
+    fn = setup()
+    rss_before = _current_rss_mb()
+    with torch.set_grad_enabled(grad):
+        fn()
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - rss_before)
+
+
+def peak_memory(setup, device=torch.device('cpu'), grad=False):
+    """
+    Extra peak memory in MB while running fn = setup(), i.e. without what setup itself allocates.
+    On CUDA from the allocator statistics. On CPU the allocator keeps no statistics, so it runs in a
+    fresh process and the max RSS over the RSS before fn() is reported -- setup must be picklable
+    (module-level function or functools.partial of one).
+    """
+    if device.type == 'cuda':
+        fn = setup()
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+        memory_before = torch.cuda.memory_allocated(device)
+        with torch.set_grad_enabled(grad):
+            fn()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated(device) - memory_before) / 1024 ** 2
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_peak_rss_worker, args=(setup, grad, queue))
+    process.start()
+    process.join()
+    return queue.get() if process.exitcode == 0 else float('nan')
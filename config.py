@@ -95,6 +95,14 @@ class Config():
             self.loss.remove('contrast')
         self.lr = 1e-4 * (self.batch_size / 16)
         self.relation_module = ['GAM', 'ICE', 'NonLocal', 'MHA'][0]
+        self.gam_chunk_size = 0         # >0 to compute the GAM affinity in tiles of that many query positions, saves memory on large groups.
+        self.gam_approx = [None, 'random', 'kmeans', 'pool'][0]       # approximate GAM for very large groups, exact if None.
+        self.gam_num_reps = 16          # representatives per image for the approximate GAM, the accuracy/speed knob.
+        self.fused_attention = True     # fused scaled_dot_product_attention in MHA and NonLocal, no full attention matrix.
+        # Training only: recompute the activations of these stages in backward instead of keeping them, for larger groups.
+        self.checkpoint_stages = ['bb', 'decoder', 'refiner', 'cls_mask'][:0]
+        self.output_stride = 1          # inference only: run the output DBHead/conv (and refiner) at 1/output_stride of the input size.
+        self.output_guided = False      # upsample these low-res predictions to the input size with a fast guided filter on the input image.
         self.self_supervision = False
         self.label_smoothing = False
         self.freeze = True
@@ -1,4 +1,6 @@
 import os
+import math
+import time
 from PIL import Image, ImageEnhance
 import torch
 import random
@@ -35,6 +37,8 @@ class CoData(data.Dataset):
             transforms.ToTensor(),
         ])
         self.load_all = False
+        # Set to a dict to accumulate the seconds spent in image decoding and preprocessing (e.g. test.py --benchmark).
+        self.timings = None
 
     def __getitem__(self, item):
         names = os.listdir(self.image_dirs[item])
@@ -84,12 +88,15 @@ class CoData(data.Dataset):
                 image = self.images_loaded[idx]
                 label = self.labels_loaded[idx]
             else:
+                time_st = time.perf_counter()
                 if not os.path.exists(image_paths[idx]):
                     image_paths[idx] = image_paths[idx].replace('.jpg', '.png') if image_paths[idx][-4:] == '.jpg' else image_paths[idx].replace('.png', '.jpg')
                 image = Image.open(image_paths[idx]).convert('RGB')
                 if not os.path.exists(label_paths[idx]):
                     label_paths[idx] = label_paths[idx].replace('.jpg', '.png') if label_paths[idx][-4:] == '.jpg' else label_paths[idx].replace('.png', '.jpg')
                 label = Image.open(label_paths[idx]).convert('L')
+                if self.timings is not None:
+                    self.timings['decode'] = self.timings.get('decode', 0.) + time.perf_counter() - time_st
 
             subpaths.append(os.path.join(image_paths[idx].split(os.sep)[-2], image_paths[idx].split(os.sep)[-1][:-4]+'.png'))
             ori_sizes.append((image.size[1], image.size[0]))
@@ -107,7 +114,10 @@ class CoData(data.Dataset):
                 if 'pepper' in Config().preproc_methods:
                     label = random_pepper(label)
 
+            time_st = time.perf_counter()
             image, label = self.transform_image(image), self.transform_label(label)
+            if self.timings is not None:
+                self.timings['preprocess'] = self.timings.get('preprocess', 0.) + time.perf_counter() - time_st
 
             images[idx] = image
             labels[idx] = label
@@ -122,8 +132,93 @@ class CoData(data.Dataset):
         return len(self.image_dirs)
 
 
-def get_loader(img_root, gt_root, img_size, batch_size, max_num = float('inf'), istrain=True, shuffle=False, num_workers=0, pin=False):
+class GroupBucketSampler(data.Sampler):
+    """
+    Packs several test groups into one batch of at most `max_batch` images.
+    Groups are sorted by size and filled first-fit, so small groups share one forward pass.
+    A group larger than `max_batch` still goes alone.
+    """
+    def __init__(self, group_sizes, max_batch):
+        self.buckets = []
+        bucket_sizes = []
+        for item in sorted(range(len(group_sizes)), key=lambda i: group_sizes[i], reverse=True):
+            for idx_bucket, bucket_size in enumerate(bucket_sizes):
+                if bucket_size + group_sizes[item] <= max_batch:
+                    self.buckets[idx_bucket].append(item)
+                    bucket_sizes[idx_bucket] += group_sizes[item]
+                    break
+            else:
+                self.buckets.append([item])
+                bucket_sizes.append(group_sizes[item])
+
+    def __iter__(self):
+        return iter(self.buckets)
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class DistributedGroupSampler(data.Sampler):
+    """
+    Shards the groups (items of CoData) across the ranks of a distributed training, so that every group
+    goes through one forward on one rank and the per-group consensus of CoAttLayer is unchanged.
+    Groups are padded by repetition to the same number per rank, which keeps the ranks in lockstep.
+    With shuffle, call set_epoch at each epoch to get a new order, the same on all ranks.
+    """
+    def __init__(self, num_groups, num_replicas, rank, shuffle=False, seed=0):
+        self.num_groups = num_groups
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = -(-num_groups // num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.num_groups, generator=generator).tolist()
+        else:
+            indices = list(range(self.num_groups))
+        # Repeated as a whole, there can be fewer groups than ranks.
+        total = self.num_samples * self.num_replicas
+        indices = (indices * math.ceil(total / len(indices)))[:total]
+        return iter(indices[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return self.num_samples
+
+
+def collate_groups(batch):
+    # Concatenate the test groups of one bucket, group_idx tells which group each image belongs to.
+    images = torch.cat([group[0] for group in batch], dim=0)
+    labels = torch.cat([group[1] for group in batch], dim=0)
+    subpaths = [subpath for group in batch for subpath in group[2]]
+    ori_sizes = [ori_size for group in batch for ori_size in group[3]]
+    group_idx = torch.cat([torch.full((group[0].shape[0],), idx_group, dtype=torch.long) for idx_group, group in enumerate(batch)])
+    return images, labels, subpaths, ori_sizes, group_idx
+
+
+def get_loader(img_root, gt_root, img_size, batch_size, max_num = float('inf'), istrain=True, shuffle=False, num_workers=0, pin=False, max_batch=None,
+               num_replicas=None, rank=None, seed=0):
     dataset = CoData(img_root, gt_root, img_size, max_num, is_train=istrain)
+    if num_replicas:
+        # Distributed training, this rank only loads its share of the groups, see DistributedGroupSampler.
+        sampler = DistributedGroupSampler(len(dataset), num_replicas, rank, shuffle=shuffle, seed=seed)
+        data_loader = data.DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers,
+                                      pin_memory=pin)
+        return data_loader
+    if not istrain:
+        # Pack whole groups up to `max_batch` images per batch, see GroupBucketSampler. Without max_batch one group
+        # per batch, test batches always come from collate_groups (with group_idx).
+        group_sizes = [len(os.listdir(image_dir)) for image_dir in dataset.image_dirs]
+        data_loader = data.DataLoader(dataset=dataset, batch_sampler=GroupBucketSampler(group_sizes, max_batch or 1),
+                                      collate_fn=collate_groups, num_workers=num_workers, pin_memory=pin)
+        return data_loader
     data_loader = data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
                                   pin_memory=pin)
     return data_loader
@@ -0,0 +1,49 @@
+import json
+import torch
+
+
+# Runners for exported GCoNet+ models (see export.py).
+# Only torch is needed here -- neither config.py nor the model code (and thus gco.sh) is imported.
+
+
+class TorchScriptRunner():
+    def __init__(self, path, device='cpu'):
+        extra_files = {'meta.json': ''}
+        self.device = torch.device(device)
+        self.model = torch.jit.load(path, map_location=self.device, _extra_files=extra_files)
+        self.model.eval()
+        self.meta = json.loads(extra_files['meta.json'])
+        # Whether the raw outputs still need a sigmoid, the same rule as in test.py.
+        self.apply_sigmoid = self.meta['apply_sigmoid']
+
+    def __call__(self, inputs, group_idx=None):
+        # inputs: N,3,H,W normalized images of one or several groups, group_idx: N, group of each image.
+        if group_idx is None:
+            group_idx = torch.zeros(inputs.shape[0], dtype=torch.long)
+        with torch.no_grad():
+            return self.model(inputs.to(self.device), group_idx.to(self.device))
+
+
+class OnnxRunner():
+    def __init__(self, path, device='cpu', num_threads=0):
+        import onnxruntime as ort
+        self.device = torch.device(device)
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, session_options, providers=['CPUExecutionProvider'])
+        self.meta = json.loads(self.session.get_modelmeta().custom_metadata_map['meta.json'])
+        self.apply_sigmoid = self.meta['apply_sigmoid']
+
+    def __call__(self, inputs, group_idx=None):
+        if group_idx is None:
+            group_idx = torch.zeros(inputs.shape[0], dtype=torch.long)
+        preds = self.session.run(None, {
+            'inputs': inputs.detach().cpu().numpy(), 'group_idx': group_idx.detach().cpu().numpy()
+        })[0]
+        return torch.from_numpy(preds).to(self.device)
+
+
+def load_runner(path, device='cpu'):
+    if path.endswith('.onnx'):
+        return OnnxRunner(path, device=device)
+    return TorchScriptRunner(path, device=device)
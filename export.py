@@ -0,0 +1,129 @@
+import json
+import time
+import argparse
+import torch
+from torch import nn
+
+from models.GCoNet_plus import GCoNet_plus
+from config import Config
+
+
+class InferenceWrapper(nn.Module):
+    # Final prediction of the inference path only, with the group index as an explicit input.
+    def __init__(self, model, channels_last=False):
+        super(InferenceWrapper, self).__init__()
+        self.model = model
+        # NHWC inputs for a model converted with model.to(memory_format=torch.channels_last), what oneDNN convs prefer on CPU.
+        self.channels_last = channels_last
+
+    def forward(self, inputs, group_idx=None):
+        if self.channels_last:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+        return self.model(inputs, group_idx=group_idx)[-1]
+
+
+def export_meta(config, size):
+    return {
+        'size': size,
+        'bb': config.bb,
+        'relation_module': config.relation_module,
+        'apply_sigmoid': not (config.db_output_refiner or (not config.refine and config.db_output_decoder)),
+    }
+
+
+def export_torchscript(model, path, size, group_size=4):
+    config = Config()
+    wrapper = InferenceWrapper(model).eval()
+    example = (torch.randn(group_size, 3, size, size), torch.zeros(group_size, dtype=torch.long))
+    with torch.no_grad():
+        # Tracing resolves all the config branches once, freezing then inlines the weights.
+        traced = torch.jit.trace(wrapper, example, check_trace=False)
+        frozen = torch.jit.freeze(traced)
+    frozen.save(path, _extra_files={'meta.json': json.dumps(export_meta(config, size))})
+    return frozen
+
+
+def export_onnx(model, path, size, group_size=4, opset_version=17):
+    import onnx
+    config = Config()
+    wrapper = InferenceWrapper(model).eval()
+    example = (torch.randn(group_size, 3, size, size), torch.zeros(group_size, dtype=torch.long))
+    with torch.no_grad():
+        # The number of images (one or several packed groups) stays a dynamic axis.
+        torch.onnx.export(
+            wrapper, example, path, input_names=['inputs', 'group_idx'], output_names=['preds'],
+            dynamic_axes={'inputs': {0: 'num_images'}, 'group_idx': {0: 'num_images'}, 'preds': {0: 'num_images'}},
+            opset_version=opset_version, dynamo=False
+        )
+    onnx_model = onnx.load(path)
+    onnx.helper.set_model_props(onnx_model, {'meta.json': json.dumps(export_meta(config, size))})
+    onnx.save(onnx_model, path)
+
+
+def check_export(model, runner, size, group_sizes=(1, 3, 7)):
+    # The traced graph must not have baked in the group size used for tracing.
+    # Also returns the share of the outputs in (0.01, 0.99): saturated ones (DBHead binarization) hide most deviations.
+    max_diff, num_unsaturated, num_preds = 0., 0, 0
+    for group_size in group_sizes:
+        inputs = torch.randn(group_size, 3, size, size)
+        with torch.no_grad():
+            preds_ref = model(inputs)[-1]
+        preds = runner(inputs).to(preds_ref.device)
+        max_diff = max(max_diff, (preds - preds_ref).abs().max().item())
+        num_unsaturated += int(((preds_ref > 0.01) & (preds_ref < 0.99)).sum())
+        num_preds += preds_ref.numel()
+    return max_diff, num_unsaturated / num_preds
+
+
+def compare_latency(model, runner, size, group_size=8, repeats=10):
+    # Average CPU latency per group of the eager model and of the exported one.
+    inputs = torch.randn(group_size, 3, size, size)
+    latencies = []
+    for forward in [lambda: model(inputs), lambda: runner(inputs)]:
+        with torch.no_grad():
+            forward()
+            time_st = time.perf_counter()
+            for _ in range(repeats):
+                forward()
+        latencies.append((time.perf_counter() - time_st) / repeats)
+    return latencies
+
+
+def main(args):
+    model = GCoNet_plus(bb_pretrained=False)
+    model.load_state_dict(torch.load(args.ckpt, map_location='cpu'))
+    model.eval()
+
+    if args.format == 'torchscript':
+        export_torchscript(model, args.output, args.size)
+    elif args.format == 'onnx':
+        export_onnx(model, args.output, args.size)
+    print('Exported {} to {}.'.format(args.ckpt, args.output))
+
+    if args.check:
+        from deploy import load_runner
+        runner = load_runner(args.output)
+        max_diff, unsaturated = check_export(model, runner, args.size)
+        print('Max abs diff to the eager model: {:.2e} ({:.1%} of the outputs unsaturated).'.format(max_diff, unsaturated))
+        latency_eager, latency_exported = compare_latency(model, runner, args.size)
+        print('CPU latency per group of 8: eager {:.1f} ms, {} {:.1f} ms.'.format(latency_eager * 1e3, args.format, latency_exported * 1e3))
+
+
+if __name__ == '__main__':
+    # Parameter from command line
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--ckpt', default='./ckpt/GCoNet_plus/final.pth', type=str, help='model weights to export')
+    parser.add_argument('--format',
+                        default='torchscript',
+                        type=str,
+                        help="Options: 'torchscript', 'onnx'")
+    parser.add_argument('--output', default='./ckpt/GCoNet_plus/final.pt', type=str, help='exported file, .pt or .onnx')
+    parser.add_argument('--size',
+                        default=224,
+                        type=int,
+                        help='input size')
+    parser.add_argument('--check', action='store_true', help='compare the exported model with the eager one')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,12 +1,11 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 from math import exp
 from config import Config
 
 
-def pairwise_distance_torch(embeddings, device=torch.device("cuda")):
+def pairwise_distance_torch(embeddings, device=None):
     """Computes the pairwise distance matrix with numerical stability.
     output[i, j] = || feature[i, :] - feature[j, :] ||_2
     Args:
@@ -15,6 +14,7 @@ def pairwise_distance_torch(embeddings, device=torch.device("cuda")):
       pairwise_distances: 2-D Tensor of size [number of data, number of data].
     """
 
+    device = embeddings.device if device is None else device
     # pairwise distance matrix with precise embeddings
     precise_embeddings = embeddings.to(dtype=torch.float32)
 
@@ -41,7 +41,7 @@ def pairwise_distance_torch(embeddings, device=torch.device("cuda")):
     pairwise_distances = torch.mul(pairwise_distances.to(device), mask_offdiagonals.to(device))
     return pairwise_distances
 
-def TripletSemiHardLoss(y_pred, y_true, device=torch.device("cuda"), margin=1.0):
+def TripletSemiHardLoss(y_pred, y_true, device=None, margin=1.0):
     """Computes the triplet loss_functions with semi-hard negative mining.
        The loss_functions encourages the positive distances (between a pair of embeddings
        with the same labels) to be smaller than the minimum negative distance
@@ -58,6 +58,7 @@ def TripletSemiHardLoss(y_pred, y_true, device=torch.device("cuda"), margin=1.0)
        """
 
     labels, embeddings = y_true, y_pred
+    device = embeddings.device if device is None else device
 
     # Reshape label tensor to [batch_size, 1].
     labels = torch.reshape(labels, [labels.shape[0], 1])
@@ -70,35 +71,21 @@ def TripletSemiHardLoss(y_pred, y_true, device=torch.device("cuda"), margin=1.0)
     adjacency_not = adjacency.logical_not()
 
     batch_size = labels.shape[0]
-
-    # Compute the mask.
-    pdist_matrix_tile = pdist_matrix.repeat(batch_size, 1)
-    adjacency_not_tile = adjacency_not.repeat(batch_size, 1)
-
-    transpose_reshape = pdist_matrix.transpose(0, 1).reshape(-1, 1)
-    greater = pdist_matrix_tile > transpose_reshape
-
-    mask = adjacency_not_tile & greater
-
-    # final mask
-    mask_step = mask.to(dtype=torch.float32)
-    mask_step = mask_step.sum(axis=1)
-    mask_step = mask_step > 0.0
-    mask_final = mask_step.reshape(batch_size, batch_size)
-    mask_final = mask_final.transpose(0, 1)
-
-    adjacency_not = adjacency_not.to(dtype=torch.float32)
-    mask = mask.to(dtype=torch.float32)
-
-    # negatives_outside: smallest D_an where D_an > D_ap.
-    axis_maximums = torch.max(pdist_matrix_tile, dim=1, keepdim=True)
-    masked_minimums = torch.min(torch.mul(pdist_matrix_tile - axis_maximums[0], mask), dim=1, keepdim=True)[0] + axis_maximums[0]
-    negatives_outside = masked_minimums.reshape([batch_size, batch_size])
-    negatives_outside = negatives_outside.transpose(0, 1)
+    adjacency_not_float = adjacency_not.to(dtype=torch.float32)
+
+    # negatives_outside: smallest D_an where D_an > D_ap, for every anchor a and positive p.
+    # Searched in the sorted negative distances of each anchor, O(B^2 log B) time and O(B^2) memory.
+    negatives_sorted = torch.sort(pdist_matrix.masked_fill(adjacency_not.logical_not(), float('inf')), dim=1)[0]
+    num_negatives = adjacency_not.sum(dim=1, keepdim=True)
+    idx_outside = torch.searchsorted(negatives_sorted.detach().contiguous(), pdist_matrix.detach().contiguous(), right=True)
+    mask_final = idx_outside < num_negatives
+    # Same arithmetic as the tiled version, (D_an - max) + max, so that the loss is bit-identical.
+    axis_maximums = torch.max(pdist_matrix, dim=1, keepdim=True)[0]
+    negatives_outside = (torch.gather(negatives_sorted, 1, idx_outside.clamp(max=batch_size - 1)) - axis_maximums) + axis_maximums
 
     # negatives_inside: largest D_an.
     axis_minimums = torch.min(pdist_matrix, dim=1, keepdim=True)
-    masked_maximums = torch.max(torch.mul(pdist_matrix - axis_minimums[0], adjacency_not), dim=1, keepdim=True)[0] + axis_minimums[0]
+    masked_maximums = torch.max(torch.mul(pdist_matrix - axis_minimums[0], adjacency_not_float), dim=1, keepdim=True)[0] + axis_minimums[0]
     negatives_inside = masked_maximums.repeat(1, batch_size)
 
     semi_hard_negatives = torch.where(mask_final, negatives_outside, negatives_inside)
@@ -148,6 +135,40 @@ class ThrReg_loss(torch.nn.Module):
         return torch.mean(1 - ((pred - 0) ** 2 + (pred - 1) ** 2))
 
 
+class SaliencyLoss(nn.Module):
+    """
+    Weighted sum of the saliency criteria with a non-zero weight in lambdas, among criteria ('bce', 'iou', 'ssim', 'mse', 'reg'),
+    same values as nn.BCELoss, IoU_loss, SSIMLoss, nn.MSELoss and ThrReg_loss, in one vectorized pass:
+    pred * gt and pred * pred are computed once and shared, IoU is reduced over the whole batch at once,
+    and the SSIM moments come from the shared SSIMEngine.
+    """
+    def __init__(self, lambdas, window_size=11, criteria=('bce', 'iou', 'ssim', 'mse', 'reg')):
+        super(SaliencyLoss, self).__init__()
+        self.lambdas = {name: weight for name, weight in lambdas.items() if name in criteria and weight}
+        self.ssim_engine = SSIMEngine(window_size)
+
+    def forward(self, pred, gt):
+        pred_gt = pred * gt
+        pred_sq = pred * pred if {'ssim', 'reg'} & set(self.lambdas) else None
+        terms = {}
+        if 'bce' in self.lambdas:
+            terms['bce'] = F.binary_cross_entropy(pred, gt)
+        if 'iou' in self.lambdas:
+            inter = pred_gt.sum(dim=(1, 2, 3))
+            union = gt.sum(dim=(1, 2, 3)) + pred.sum(dim=(1, 2, 3)) - inter
+            terms['iou'] = (1 - inter / union).sum()
+        if 'ssim' in self.lambdas:
+            terms['ssim'] = 1 - self.ssim_engine.ssim_map(pred, gt, x_sq=pred_sq, xy=pred_gt).mean()
+        if 'mse' in self.lambdas:
+            terms['mse'] = F.mse_loss(pred, gt)
+        if 'reg' in self.lambdas:
+            terms['reg'] = torch.mean(1 - (pred_sq + (pred - 1) ** 2))
+        loss = 0
+        for name in self.lambdas:
+            loss += terms[name] * self.lambdas[name]
+        return loss
+
+
 class DSLoss(nn.Module):
     """
     IoU loss for outputs in [1:] scales.
@@ -159,33 +180,16 @@ class DSLoss(nn.Module):
         self.lambdas_sal_others = self.config.lambdas_sal_others
         self.triplet_loss = ['vanilla', 'semi_hard'][0]
 
-        self.criterions_last = {}
-        if 'bce' in self.lambdas_sal_last and self.lambdas_sal_last['bce']:
-            self.criterions_last['bce'] = nn.BCELoss()
-        if 'iou' in self.lambdas_sal_last and self.lambdas_sal_last['iou']:
-            self.criterions_last['iou'] = IoU_loss()
-        if 'ssim' in self.lambdas_sal_last and self.lambdas_sal_last['ssim']:
-            self.criterions_last['ssim'] = SSIMLoss()
-        if 'mse' in self.lambdas_sal_last and self.lambdas_sal_last['mse']:
-            self.criterions_last['mse'] = nn.MSELoss()
-        if 'reg' in self.lambdas_sal_last and self.lambdas_sal_last['reg']:
-            self.criterions_last['reg'] = ThrReg_loss()
+        self.criterion_last = SaliencyLoss(self.lambdas_sal_last)
         if 'triplet' in self.lambdas_sal_last and self.lambdas_sal_last['triplet']:
             margin = self.config.triplet_loss_margin
             if self.triplet_loss == 'vanilla':
                 self.criterion_triplet = nn.TripletMarginLoss(margin=margin)
-            elif self.criterion_triplet == 'semi_hard':
+            elif self.triplet_loss == 'semi_hard':
                 self.criterion_triplet = TripletLoss(margin=margin)
 
-        self.criterions_others = {}
-        if 'bce' in self.lambdas_sal_others and self.lambdas_sal_others['bce']:
-            self.criterions_others['bce'] = nn.BCELoss()
-        if 'iou' in self.lambdas_sal_others and self.lambdas_sal_others['iou']:
-            self.criterions_others['iou'] = IoU_loss()
-        if 'ssim' in self.lambdas_sal_others and self.lambdas_sal_others['ssim']:
-            self.criterions_others['ssim'] = SSIMLoss()
-        if 'mse' in self.lambdas_sal_others and self.lambdas_sal_others['mse']:
-            self.criterions_others['mse'] = nn.MSELoss()
+        # The intermediate outputs have never had the 'reg' term.
+        self.criterion_others = SaliencyLoss(self.lambdas_sal_others, criteria=('bce', 'iou', 'ssim', 'mse'))
 
     def forward(self, scaled_preds, gt, norm_features=None, labels=None):
         loss = 0
@@ -195,8 +199,7 @@ class DSLoss(nn.Module):
             if idx_output == len(scaled_preds) - 1:
                 if not(self.config.db_output_refiner or (not self.config.refine and self.config.db_output_decoder)):
                     pred_lvl = pred_lvl.sigmoid()
-                for criterion_name, criterion in self.criterions_last.items():
-                    loss += criterion(pred_lvl, gt) * self.lambdas_sal_last[criterion_name]
+                loss += self.criterion_last(pred_lvl, gt)
                 # loss_outside = self.criterions_last['iou'](pred_lvl * (1 - gt), gt * (1 - gt)) * self.lambdas_sal_last['iou'] * 2
                 # loss_inside = self.criterions_last['bce'](pred_lvl * gt, gt) * self.lambdas_sal_last['bce'] * 2
                 # loss_inside += self.criterions_last['mse'](pred_lvl * gt, gt) * self.lambdas_sal_last['mse'] * 2
@@ -204,8 +207,7 @@ class DSLoss(nn.Module):
             else:
                 if not (self.config.refine and self.config.db_output_decoder and idx_output == len(scaled_preds) - 2):
                     pred_lvl = pred_lvl.sigmoid()
-                for criterion_name, criterion in self.criterions_others.items():
-                    loss += criterion(pred_lvl, gt) * self.lambdas_sal_others[criterion_name]
+                loss += self.criterion_others(pred_lvl, gt)
         if self.lambdas_sal_last['triplet'] and norm_features is not None:
             triplet_loss = 0
             for norm_feature in norm_features:
@@ -231,21 +233,14 @@ class SSIMLoss(torch.nn.Module):
         super(SSIMLoss, self).__init__()
         self.window_size = window_size
         self.size_average = size_average
-        self.channel = 1
-        self.window = create_window(window_size, self.channel)
+        self.engine = SSIMEngine(window_size)
 
     def forward(self, img1, img2):
-        (_, channel, _, _) = img1.size()
-        if channel == self.channel and self.window.data.type() == img1.data.type():
-            window = self.window
+        ssim_map = self.engine.ssim_map(img1, img2)
+        if self.size_average:
+            return 1 - ssim_map.mean()
         else:
-            window = create_window(self.window_size, channel)
-            if img1.is_cuda:
-                window = window.cuda(img1.get_device())
-            window = window.type_as(img1)
-            self.window = window
-            self.channel = channel
-        return 1 - _ssim(img1, img2, window, self.window_size, channel, self.size_average)
+            return 1 - ssim_map.mean(1).mean(1).mean(1)
 
 
 def gaussian(window_size, sigma):
@@ -253,55 +248,84 @@ def gaussian(window_size, sigma):
     return gauss/gauss.sum()
 
 
-def create_window(window_size, channel):
-    _1D_window = gaussian(window_size, 1.5).unsqueeze(1)
-    _2D_window = _1D_window.mm(_1D_window.t()).float().unsqueeze(0).unsqueeze(0)
-    window = Variable(_2D_window.expand(channel, 1, window_size, window_size).contiguous())
-    return window
+class SSIMEngine():
+    """
+    Local SSIM statistics for SSIMLoss, SaliencyLoss and saliency_structure_consistency.
+    The Gaussian window is applied as two separable 1D passes to the five moment maps (x, y, x^2, y^2, xy) at once,
+    two grouped window_size x 1 and 1 x window_size convs, O(window_size) per pixel. On CPU only, maps up to
+    band_limit pixels per side are filtered by matmuls with banded H x H and W x W matrices instead (zero padding
+    included): O(H + W) per pixel, but measured faster than the grouped convs there (benchmarks/ssim.py).
+    The band matrices and 1D windows are cached per (size, dtype, device) and (channel, dtype, device).
+    With window='box' the moments are plain avg_pool2d (zero padding counted, like nn.AvgPool2d).
+    """
+    def __init__(self, window_size=11, sigma=1.5, window='gaussian', band_limit=512):
+        self.window_size = window_size
+        self.sigma = sigma
+        self.box = window == 'box'
+        self.band_limit = band_limit
+        self.windows = {}
+        self.bands = {}
+
+    def window(self, channel, like):
+        key = (channel, like.dtype, like.device)
+        if key not in self.windows:
+            window_1d = gaussian(self.window_size, self.sigma).to(dtype=like.dtype, device=like.device)
+            window_1d = window_1d.expand(5 * channel, 1, self.window_size)
+            self.windows[key] = (window_1d.unsqueeze(3).contiguous(), window_1d.unsqueeze(2).contiguous())
+        return self.windows[key]
+
+    def band(self, size, like):
+        # band[i, j] = window[j - i + window_size // 2], i.e. band @ x filters the rows of x with zero padding.
+        key = (size, like.dtype, like.device)
+        if key not in self.bands:
+            offsets = torch.arange(size).unsqueeze(0) - torch.arange(size).unsqueeze(1) + self.window_size // 2
+            window_1d = gaussian(self.window_size, self.sigma)
+            band = torch.where((offsets >= 0) & (offsets < self.window_size), window_1d[offsets.clamp(0, self.window_size - 1)], torch.zeros(()))
+            self.bands[key] = band.to(dtype=like.dtype, device=like.device)
+        return self.bands[key]
+
+    def moments(self, x, y, x_sq=None, xy=None):
+        # Local means of x, y, x^2, y^2 and xy, x_sq/xy can be passed in when the caller already has them.
+        maps = [x, y, x * x if x_sq is None else x_sq, y * y, x * y if xy is None else xy]
+        if self.box:
+            # One pool per map, concatenating them first is slower on CPU.
+            return [F.avg_pool2d(moment, self.window_size, 1, self.window_size // 2) for moment in maps]
+        channel = x.shape[1]
+        maps = torch.cat(maps, dim=1)
+        if x.device.type == 'cpu' and max(maps.shape[2:]) <= self.band_limit:
+            maps = torch.matmul(torch.matmul(self.band(maps.shape[2], x), maps), self.band(maps.shape[3], x).t())
+        else:
+            window_v, window_h = self.window(channel, x)
+            padding = self.window_size // 2
+            maps = F.conv2d(maps, window_v, padding=(padding, 0), groups=5 * channel)
+            maps = F.conv2d(maps, window_h, padding=(0, padding), groups=5 * channel)
+        return maps.split(channel, dim=1)
 
+    def ssim_map(self, x, y, x_sq=None, xy=None):
+        return _ssim_from_moments(*self.moments(x, y, x_sq=x_sq, xy=xy))
 
-def _ssim(img1, img2, window, window_size, channel, size_average=True):
-    mu1 = F.conv2d(img1, window, padding = window_size//2, groups=channel)
-    mu2 = F.conv2d(img2, window, padding = window_size//2, groups=channel)
 
+def _ssim_from_moments(mu1, mu2, img1_sq_mean, img2_sq_mean, img1_img2_mean):
+    # SSIM map from the local means of img1, img2, img1^2, img2^2 and img1*img2.
     mu1_sq = mu1.pow(2)
     mu2_sq = mu2.pow(2)
     mu1_mu2 = mu1*mu2
 
-    sigma1_sq = F.conv2d(img1*img1, window, padding=window_size//2, groups=channel) - mu1_sq
-    sigma2_sq = F.conv2d(img2*img2, window, padding=window_size//2, groups=channel) - mu2_sq
-    sigma12 = F.conv2d(img1*img2, window, padding=window_size//2, groups=channel) - mu1_mu2
+    sigma1_sq = img1_sq_mean - mu1_sq
+    sigma2_sq = img2_sq_mean - mu2_sq
+    sigma12 = img1_img2_mean - mu1_mu2
 
     C1 = 0.01**2
     C2 = 0.03**2
 
-    ssim_map = ((2*mu1_mu2 + C1)*(2*sigma12 + C2))/((mu1_sq + mu2_sq + C1)*(sigma1_sq + sigma2_sq + C2))
+    return ((2*mu1_mu2 + C1)*(2*sigma12 + C2))/((mu1_sq + mu2_sq + C1)*(sigma1_sq + sigma2_sq + C2))
 
-    if size_average:
-        return ssim_map.mean()
-    else:
-        return ssim_map.mean(1).mean(1).mean(1)
 
+_box_ssim = SSIMEngine(window_size=3, window='box')
 
-def SSIM(x, y):
-    C1 = 0.01 ** 2
-    C2 = 0.03 ** 2
-
-    mu_x = nn.AvgPool2d(3, 1, 1)(x)
-    mu_y = nn.AvgPool2d(3, 1, 1)(y)
-    mu_x_mu_y = mu_x * mu_y
-    mu_x_sq = mu_x.pow(2)
-    mu_y_sq = mu_y.pow(2)
-
-    sigma_x = nn.AvgPool2d(3, 1, 1)(x * x) - mu_x_sq
-    sigma_y = nn.AvgPool2d(3, 1, 1)(y * y) - mu_y_sq
-    sigma_xy = nn.AvgPool2d(3, 1, 1)(x * y) - mu_x_mu_y
 
-    SSIM_n = (2 * mu_x_mu_y + C1) * (2 * sigma_xy + C2)
-    SSIM_d = (mu_x_sq + mu_y_sq + C1) * (sigma_x + sigma_y + C2)
-    SSIM = SSIM_n / SSIM_d
-
-    return torch.clamp((1 - SSIM) / 2, 0, 1)
+def SSIM(x, y):
+    return torch.clamp((1 - _box_ssim.ssim_map(x, y)) / 2, 0, 1)
 
 
 def saliency_structure_consistency(x, y):
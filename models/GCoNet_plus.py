@@ -1,24 +1,42 @@
+import contextlib
 from collections import OrderedDict
 import torch
 from torch.functional import norm
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torchvision.models import vgg16, vgg16_bn
 import fvcore.nn.weight_init as weight_init
 from torchvision.models import resnet50
 
-from models.modules import ResBlk, DSLayer, half_DSLayer, CoAttLayer, RefUnet, DBHead
+from models.modules import ResBlk, DSLayer, half_DSLayer, CoAttLayer, RefUnet, DBHead, guided_upsample
 
 from config import Config
 
 
+@contextlib.contextmanager
+def keep_bn_stats(module):
+    # The recompute pass of checkpoint() runs the BNs of module a second time, their running stats
+    # (and num_batches_tracked) are restored afterwards so they get one update per step as without checkpointing.
+    buffers = [
+        (buffer, buffer.clone()) for layer in module.modules() if isinstance(layer, nn.modules.batchnorm._BatchNorm)
+        for buffer in layer.buffers(recurse=False)
+    ]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for buffer, value in buffers:
+                buffer.copy_(value)
+
+
 class GCoNet_plus(nn.Module):
-    def __init__(self):
+    def __init__(self, bb_pretrained=True):
         super(GCoNet_plus, self).__init__()
         self.config = Config()
         bb = self.config.bb
         if bb == 'vgg16':
-            bb_net = list(vgg16(pretrained=True).children())[0]
+            bb_net = list(vgg16(pretrained=bb_pretrained).children())[0]
             bb_convs = OrderedDict({
                 'conv1': bb_net[:4],
                 'conv2': bb_net[4:9],
@@ -28,7 +46,7 @@ class GCoNet_plus(nn.Module):
             })
             channel_scale = 1
         elif bb == 'resnet50':
-            bb_net = list(resnet50(pretrained=True).children())
+            bb_net = list(resnet50(pretrained=bb_pretrained).children())
             bb_convs = OrderedDict({
                 'conv1': nn.Sequential(*bb_net[0:3]),
                 'conv2': bb_net[4],
@@ -38,7 +56,7 @@ class GCoNet_plus(nn.Module):
             })
             channel_scale = 4
         elif bb == 'vgg16bn':
-            bb_net = list(vgg16_bn(pretrained=True).children())[0]
+            bb_net = list(vgg16_bn(pretrained=bb_pretrained).children())[0]
             bb_convs = OrderedDict({
                 'conv1': bb_net[:6],
                 'conv2': bb_net[6:13],
@@ -111,15 +129,26 @@ class GCoNet_plus(nn.Module):
         if self.config.cls_mask_operation == 'c':
             self.conv_cat_mask = nn.Conv2d(4, 3, 1, 1, 0)
 
-    def forward(self, x, vis=None):
+        # Outputs of the training forward, resolved once from config.loss instead of in every forward.
+        train_outputs_options = [['sal', 'cls', 'contrast', 'cls_mask'], ['sal', 'cls', 'contrast'], ['sal', 'cls', 'cls_mask'], ['sal', 'cls'], ['sal', 'contrast'], ['sal', 'cls_mask']]
+        self.train_outputs = next((outputs for outputs in train_outputs_options if set(outputs) == set(self.config.loss)), ['sal'])
+
+    def checkpointed(self, stage, module):
+        # Recompute the activations of this stage in backward instead of keeping them (Config.checkpoint_stages).
+        if stage in self.config.checkpoint_stages and self.training and torch.is_grad_enabled():
+            context_fn = lambda: (contextlib.nullcontext(), keep_bn_stats(module))
+            return lambda *args: checkpoint(module, *args, use_reentrant=False, context_fn=context_fn)
+        return module
+
+    def forward(self, x, vis=None, group_idx=None):
         ########## Encoder ##########
 
         [N, _, H, W] = x.size()
-        x1 = self.bb.conv1(x)
-        x2 = self.bb.conv2(x1)
-        x3 = self.bb.conv3(x2)
-        x4 = self.bb.conv4(x3)
-        x5 = self.bb.conv5(x4)
+        x1 = self.checkpointed('bb', self.bb.conv1)(x)
+        x2 = self.checkpointed('bb', self.bb.conv2)(x1)
+        x3 = self.checkpointed('bb', self.bb.conv3)(x2)
+        x4 = self.checkpointed('bb', self.bb.conv4)(x3)
+        x5 = self.checkpointed('bb', self.bb.conv5)(x4)
 
         if 'cls' in self.config.loss:
             _x5 = self.avgpool(x5)
@@ -129,7 +158,7 @@ class GCoNet_plus(nn.Module):
             pred_cls = self.classifier(_x5)
 
         if self.config.GAM:
-            weighted_x5, neg_x5 = self.co_x5(x5)
+            weighted_x5, neg_x5 = self.co_x5(x5, group_idx=group_idx)
             if 'contrast' in self.config.loss:
                 if self.training:
                     ########## contrastive branch #########
@@ -142,43 +171,46 @@ class GCoNet_plus(nn.Module):
 
         ########## Decoder ##########
         scaled_preds = []
-        p5 = self.enlayer5(p5)
+        decoder = lambda module: self.checkpointed('decoder', module)
+        p5 = decoder(self.enlayer5)(p5)
         p5 = F.interpolate(p5, size=x4.shape[2:], mode='bilinear', align_corners=True)
         if self.config.conv_after_itp:
-            p5 = self.dslayer5(p5)
-        p4 = p5 + self.latlayer5(x4)
+            p5 = decoder(self.dslayer5)(p5)
+        p4 = p5 + decoder(self.latlayer5)(x4)
 
-        p4 = self.enlayer4(p4)
+        p4 = decoder(self.enlayer4)(p4)
         p4 = F.interpolate(p4, size=x3.shape[2:], mode='bilinear', align_corners=True)
         if self.config.conv_after_itp:
-            p4 = self.dslayer4(p4)
+            p4 = decoder(self.dslayer4)(p4)
         if self.config.output_number >= 4:
             p4_out = self.conv_out4(p4)
             scaled_preds.append(p4_out)
-        p3 = p4 + self.latlayer4(x3)
+        p3 = p4 + decoder(self.latlayer4)(x3)
 
-        p3 = self.enlayer3(p3)
+        p3 = decoder(self.enlayer3)(p3)
         p3 = F.interpolate(p3, size=x2.shape[2:], mode='bilinear', align_corners=True)
         if self.config.conv_after_itp:
-            p3 = self.dslayer3(p3)
+            p3 = decoder(self.dslayer3)(p3)
         if self.config.output_number >= 3:
             p3_out = self.conv_out3(p3)
             scaled_preds.append(p3_out)
-        p2 = p3 + self.latlayer3(x2)
+        p2 = p3 + decoder(self.latlayer3)(x2)
 
-        p2 = self.enlayer2(p2)
+        p2 = decoder(self.enlayer2)(p2)
         p2 = F.interpolate(p2, size=x1.shape[2:], mode='bilinear', align_corners=True)
         if self.config.conv_after_itp:
-            p2 = self.dslayer2(p2)
+            p2 = decoder(self.dslayer2)(p2)
         if self.config.output_number >= 2:
             p2_out = self.conv_out2(p2)
             scaled_preds.append(p2_out)
-        p1 = p2 + self.latlayer2(x1)
+        p1 = p2 + decoder(self.latlayer2)(x1)
 
-        p1 = self.enlayer1(p1)
-        p1 = F.interpolate(p1, size=x.shape[2:], mode='bilinear', align_corners=True)
+        p1 = decoder(self.enlayer1)(p1)
+        # In inference, the output head can run at 1/output_stride of the input size, the predictions are upsampled once at the end.
+        output_stride = 1 if self.training else self.config.output_stride
+        p1 = F.interpolate(p1, size=(H // output_stride, W // output_stride), mode='bilinear', align_corners=True)
         if self.config.db_output_decoder:
-            p1_out = self.db_output_decoder(p1)
+            p1_out = decoder(self.db_output_decoder)(p1)
         else:
             p1_out = self.conv_out1(p1)
         if vis == 'CAM':
@@ -189,11 +221,17 @@ class GCoNet_plus(nn.Module):
         scaled_preds.append(p1_out)
 
         if self.config.refine == 1:
-            scaled_preds.append(self.refiner(p1_out))
+            scaled_preds.append(self.checkpointed('refiner', self.refiner)(p1_out))
         elif self.config.refine == 4:
-            scaled_preds.append(self.refiner(torch.cat([x, p1_out], dim=1)))
+            x_out = x if output_stride == 1 else F.interpolate(x, size=p1_out.shape[2:], mode='bilinear', align_corners=True)
+            scaled_preds.append(self.checkpointed('refiner', self.refiner)(torch.cat([x_out, p1_out], dim=1)))
+        if output_stride > 1 and self.config.output_guided:
+            # Guided by the luminance of the input, the final prediction comes back at the input size.
+            # DBHead outputs are probabilities (no sigmoid in test.py), they are kept in [0, 1].
+            is_probability = self.config.db_output_refiner or (not self.config.refine and self.config.db_output_decoder)
+            scaled_preds[-1] = guided_upsample(scaled_preds[-1], x.mean(dim=1, keepdim=True), clamp=is_probability)
 
-        if 'cls_mask' in self.config.loss:
+        if 'cls_mask' in self.config.loss and self.training:
             pred_cls_masks = []
             norm_features_mask = []
             input_features = [x, x1, x2, x3][:self.config.loss_cls_mask_last_layers]
@@ -215,7 +253,7 @@ class GCoNet_plus(nn.Module):
                 elif self.config.cls_mask_operation == 'c':
                     masked_features = self.conv_cat_mask(torch.cat((input_features[idx_out], mask_output), dim=1))
                 norm_feature_mask = self.avgpool(
-                    nn.Sequential(*bb_lst[idx_out:])(
+                    self.checkpointed('cls_mask', nn.Sequential(*bb_lst[idx_out:]))(
                         masked_features
                     )
                 ).view(N, -1)
@@ -227,22 +265,15 @@ class GCoNet_plus(nn.Module):
                 )
 
         if self.training:
-            return_values = []
-            if {'sal', 'cls', 'contrast', 'cls_mask'} == set(self.config.loss):
-                return_values = [scaled_preds, pred_cls, pred_contrast, pred_cls_masks]
-            elif {'sal', 'cls', 'contrast'} == set(self.config.loss):
-                return_values = [scaled_preds, pred_cls, pred_contrast]
-            elif {'sal', 'cls', 'cls_mask'} == set(self.config.loss):
-                return_values = [scaled_preds, pred_cls, pred_cls_masks]
-            elif {'sal', 'cls'} == set(self.config.loss):
-                return_values = [scaled_preds, pred_cls]
-            elif {'sal', 'contrast'} == set(self.config.loss):
-                return_values = [scaled_preds, pred_contrast]
-            elif {'sal', 'cls_mask'} == set(self.config.loss):
-                return_values = [scaled_preds, pred_cls_masks]
-            else:
-                return_values = [scaled_preds]
-            
+            outputs = {'sal': scaled_preds}
+            if 'cls' in self.train_outputs:
+                outputs['cls'] = pred_cls
+            if 'contrast' in self.train_outputs:
+                outputs['contrast'] = pred_contrast
+            if 'cls_mask' in self.train_outputs:
+                outputs['cls_mask'] = pred_cls_masks
+            return_values = [outputs[name] for name in self.train_outputs]
+
             if self.config.lambdas_sal_last['triplet']:
                 norm_features = []
                 if '_x5' in self.config.triplet:
@@ -0,0 +1,45 @@
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def fold_batchnorm(model):
+    """
+    Fold every BatchNorm2d into the conv feeding it and drop the no-op layers, in place.
+    Covers the Conv->BN->ReLU stacks in nn.Sequential (vgg16bn, DBHead, NonLocal.W, ResNet downsample)
+    and the named pairs of ResBlk, DSLayer, RefUnet and ResNet Bottleneck (bn_in -> conv_in, bn1 -> conv1,
+    pred_bn -> pred_conv, ...). The ReLUs are left as they are: they are in-place and eager mode has no
+    conv+ReLU kernel, benchmarks/fusion.py reports their share of the forward time.
+    Only for inference: the folded convs use the running statistics of BN.
+    """
+    assert not model.training, 'Call model.eval() before folding BN.'
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            _fold_sequential(module)
+        else:
+            _fold_named_pairs(module)
+    return model
+
+
+def _fold_sequential(seq):
+    layers = []
+    for name, layer in seq.named_children():
+        if isinstance(layer, nn.BatchNorm2d) and layers and isinstance(layers[-1][1], nn.Conv2d):
+            layers[-1] = (layers[-1][0], fuse_conv_bn_eval(layers[-1][1], layer))
+        elif not isinstance(layer, (nn.Identity, nn.Dropout)):
+            layers.append((name, layer))
+    if len(layers) == len(seq):
+        return
+    # Rebuild in place, the remaining layers keep their names.
+    seq._modules.clear()
+    for name, layer in layers:
+        seq.add_module(name, layer)
+
+
+def _fold_named_pairs(module):
+    for bn_name, bn in list(module.named_children()):
+        if not isinstance(bn, nn.BatchNorm2d):
+            continue
+        conv = getattr(module, bn_name.replace('bn', 'conv'), None)
+        if isinstance(conv, nn.Conv2d):
+            setattr(module, bn_name.replace('bn', 'conv'), fuse_conv_bn_eval(conv, bn))
+            setattr(module, bn_name, nn.Identity())
@@ -98,7 +98,7 @@ class CoAttLayer(nn.Module):
         for layer in [self.conv_output, self.conv_transform, self.fc_transform]:
             weight_init.c2_msra_fill(layer)
     
-    def forward(self, x5):
+    def forward(self, x5, group_idx=None):
         if self.training:
             f_begin = 0
             f_end = int(x5.shape[0] / 2)
@@ -126,9 +126,14 @@ class CoAttLayer(nn.Module):
             neg_x5 = torch.cat([x5_12, x5_21], dim=0)
         else:
 
-            x5_new = self.all_attention(x5)
-            x5_proto = torch.mean(x5_new, (0, 2, 3), True).view(1, -1)
-            x5_proto = x5_proto.unsqueeze(-1).unsqueeze(-1) # 1, C, 1, 1
+            x5_new = self.all_attention(x5, group_idx=group_idx)
+            if group_idx is None:
+                x5_proto = torch.mean(x5_new, (0, 2, 3), True).view(1, -1)
+            else:
+                # several groups packed in one batch: each image gets the prototype of its own group
+                group_mask = (group_idx.unsqueeze(1) == group_idx.unsqueeze(0)).to(x5_new.dtype) # N, N
+                x5_proto = torch.matmul(group_mask, torch.mean(x5_new, (2, 3))) / group_mask.sum(-1, keepdim=True) # N, C
+            x5_proto = x5_proto.unsqueeze(-1).unsqueeze(-1) # 1 or N, C, 1, 1
 
             weighted_x5 = x5 * x5_proto #* cweight
             neg_x5 = None
@@ -147,7 +152,8 @@ class ICE(nn.Module):
         self.fc_2 = nn.Linear(channel_in, channel_in)
         self.fc_3 = nn.Linear(channel_in, channel_in)
 
-    def forward(self, x):
+    def forward(self, x, group_idx=None):
+        # ICE works on each image independently, so packed groups need no special handling.
         x_1, x_2, x_3 = x, x, x
 
         x_1 = x_1 * x_2 * x_3
@@ -186,12 +192,18 @@ class GAM(nn.Module):
         self.scale = 1.0 / (channel_in ** 0.5)
 
         self.conv6 = nn.Conv2d(channel_in, channel_in, kernel_size=1, stride=1, padding=0) 
+        # 0 -- full BHW x BHW affinity matrix, >0 -- computed in tiles of that many query positions.
+        self.chunk_size = config.gam_chunk_size
+        # Approximate the max-affinity to the other images with num_reps representative keys per image.
+        self.approx = config.gam_approx
+        self.num_reps = config.gam_num_reps
 
         for layer in [self.query_transform, self.key_transform, self.conv6]:
             weight_init.c2_msra_fill(layer)
 
-    def forward(self, x5):
+    def forward(self, x5, group_idx=None):
         # x: B,C,H,W
+        # group_idx: B, group of each image when several groups are packed in one batch
         # x_query: B,C,HW
         B, C, H5, W5 = x5.size()
 
@@ -205,10 +217,23 @@ class GAM(nn.Module):
         x_key = torch.transpose(x_key, 0, 1).contiguous().view(C, -1) # C, BHW
 
         # W = Q^T K: B,HW,HW
-        x_w = torch.matmul(x_query, x_key) #* self.scale # BHW, BHW
-        x_w = x_w.view(B*H5*W5, B, H5*W5)
-        x_w = torch.max(x_w, -1).values # BHW, B
-        x_w = x_w.mean(-1)
+        if group_idx is None:
+            x_w = self.max_affinity(x_query, x_key, B, H5, W5).mean(-1)
+        elif torch.jit.is_tracing() or torch.jit.is_scripting():
+            # Exported graphs (export.py) cannot loop over the groups of their inputs:
+            # affinities of the whole batch, only those to the images of the same group are averaged.
+            x_w = self.max_affinity(x_query, x_key, B, H5, W5)
+            group_mask = (group_idx.unsqueeze(1) == group_idx.unsqueeze(0)).to(x_w.dtype) # B, B
+            x_w = (x_w.view(B, H5*W5, B) * group_mask.unsqueeze(1)).sum(-1) / group_mask.sum(-1, keepdim=True) # B, HW
+        else:
+            # Packed groups: the affinity of each group to itself only, so K groups cost K affinities of one group
+            # instead of one of K times its size.
+            HW = H5*W5
+            x_w = x_query.new_empty(B, HW)
+            for group in group_idx.unique():
+                images = (group_idx == group).nonzero().squeeze(1)
+                positions = (images.unsqueeze(1) * HW + torch.arange(HW, device=images.device)).flatten()
+                x_w[images] = self.max_affinity(x_query[positions], x_key[:, positions], len(images), H5, W5).mean(-1).view(-1, HW)
         #x_w = torch.mean(x_w, -1).values # BHW
         x_w = x_w.view(B, -1) * self.scale # B, HW
         x_w = F.softmax(x_w, dim=-1) # B, HW
@@ -219,6 +244,65 @@ class GAM(nn.Module):
 
         return x5
 
+    def max_affinity(self, x_query, x_key, B, H5, W5):
+        # x_query: BHW, C, x_key: C, BHW -> BHW, B, the max affinity of each query position to each image.
+        if self.approx and self.num_reps < H5*W5:
+            return self.max_affinity_approx(x_query, x_key, B, H5, W5)
+        if self.chunk_size:
+            return self.max_affinity_chunked(x_query, x_key, B, H5*W5)
+        x_w = torch.matmul(x_query, x_key) #* self.scale # BHW, BHW
+        x_w = x_w.view(B*H5*W5, B, H5*W5)
+        return torch.max(x_w, -1).values # BHW, B
+
+    def max_affinity_chunked(self, x_query, x_key, B, HW):
+        # Same as the max over each image's positions of x_query @ x_key, but tile by tile,
+        # so memory is linear in B*HW instead of quadratic. The mean over images is left to the caller.
+        x_w = x_query.new_empty(B*HW, B) # BHW, B
+        num_images_per_tile = max(1, self.chunk_size // HW)
+        for q_begin in range(0, B*HW, self.chunk_size):
+            q_end = min(q_begin + self.chunk_size, B*HW)
+            for k_begin in range(0, B, num_images_per_tile):
+                k_end = min(k_begin + num_images_per_tile, B)
+                x_w_tile = torch.matmul(x_query[q_begin:q_end], x_key[:, k_begin*HW:k_end*HW]) # q, k*HW
+                x_w[q_begin:q_end, k_begin:k_end] = torch.max(x_w_tile.view(q_end - q_begin, k_end - k_begin, HW), -1).values
+        return x_w
+
+    def max_affinity_approx(self, x_query, x_key, B, H5, W5):
+        # Max-affinity to the other images taken over num_reps representatives of each image instead of all its HW keys:
+        # O(BHW * B * num_reps) instead of O((BHW)^2). The affinity of each image to itself stays exact, it is only O(B * HW^2).
+        HW = H5 * W5
+        C = x_query.shape[-1]
+        x_key = x_key.view(C, B, HW).permute(1, 2, 0) # B, HW, C
+        x_reps = self.representatives(x_key, H5, W5) # B, k, C
+        x_w = torch.matmul(x_query, x_reps.reshape(-1, C).t()) # BHW, Bk
+        x_w = torch.max(x_w.view(B*HW, B, -1), -1).values # BHW, B
+        x_w_self = torch.max(torch.matmul(x_query.view(B, HW, C), x_key.transpose(1, 2)), -1).values # B, HW
+        x_w = x_w.view(B, HW, B).clone()
+        x_w[torch.arange(B), :, torch.arange(B)] = x_w_self
+        return x_w.view(B*HW, B)
+
+    def representatives(self, x_key, H5, W5):
+        # x_key: B, HW, C -> B, num_reps, C
+        B, HW, C = x_key.shape
+        if self.approx == 'pool':
+            # Average-pooled keys on a grid of about num_reps cells.
+            grid_size = max(1, int(self.num_reps ** 0.5))
+            x_reps = F.adaptive_avg_pool2d(x_key.transpose(1, 2).reshape(B, C, H5, W5), grid_size)
+            return x_reps.flatten(2).transpose(1, 2)
+        rand_idx = torch.rand(B, HW, device=x_key.device).argsort(-1)[:, :self.num_reps] # B, k
+        x_reps = torch.gather(x_key, 1, rand_idx.unsqueeze(-1).expand(-1, -1, C))
+        if self.approx == 'kmeans':
+            # A few Lloyd iterations from the random keys, then the key closest to each centroid.
+            for _ in range(3):
+                assignment = torch.cdist(x_key, x_reps).argmin(-1) # B, HW
+                one_hot = F.one_hot(assignment, self.num_reps).to(x_key.dtype) # B, HW, k
+                centroids = torch.matmul(one_hot.transpose(1, 2), x_key) / one_hot.sum(1).unsqueeze(-1).clamp(min=1)
+                # empty clusters keep their previous centroid
+                x_reps = torch.where(one_hot.sum(1).unsqueeze(-1) > 0, centroids, x_reps)
+            nearest_idx = torch.cdist(x_reps, x_key).argmin(-1) # B, k
+            x_reps = torch.gather(x_key, 1, nearest_idx.unsqueeze(-1).expand(-1, -1, C))
+        return x_reps
+
 
 class MHA(nn.Module):
     '''
@@ -246,6 +330,7 @@ class MHA(nn.Module):
         self.d_k = d_k
         self.d_v = d_v
         self.h = h
+        self.fused = config.fused_attention
 
         self.init_weights()
 
@@ -263,7 +348,7 @@ class MHA(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, attention_mask=None, attention_weights=None):
+    def forward(self, x, attention_mask=None, attention_weights=None, group_idx=None):
         '''
         Computes
         :param queries: Queries (b_s, nq, d_model)
@@ -271,29 +356,35 @@ class MHA(nn.Module):
         :param values: Values (b_s, nk, d_model)
         :param attention_mask: Mask over attention values (b_s, h, nq, nk). True indicates masking.
         :param attention_weights: Multiplicative weights for attention values (b_s, h, nq, nk).
+        :param group_idx: Unused, attention is computed within each image.
         :return:
         '''
         B, C, H, W = x.size()
+        # queries, keys and values all come from query_transform, computed once.
         queries = self.query_transform(x).view(B, -1, C)
-        keys = self.query_transform(x).view(B, -1, C)
-        values = self.query_transform(x).view(B, -1, C)
+        keys = values = queries
 
         b_s, nq = queries.shape[:2]
         nk = keys.shape[1]
 
         q = self.fc_q(queries).view(b_s, nq, self.h, self.d_k).permute(0, 2, 1, 3)  # (b_s, h, nq, d_k)
-        k = self.fc_k(keys).view(b_s, nk, self.h, self.d_k).permute(0, 2, 3, 1)  # (b_s, h, d_k, nk)
+        k = self.fc_k(keys).view(b_s, nk, self.h, self.d_k).permute(0, 2, 1, 3)  # (b_s, h, nk, d_k)
         v = self.fc_v(values).view(b_s, nk, self.h, self.d_v).permute(0, 2, 1, 3)  # (b_s, h, nk, d_v)
 
-        att = torch.matmul(q, k) / np.sqrt(self.d_k)  # (b_s, h, nq, nk)
-        if attention_weights is not None:
-            att = att * attention_weights
-        if attention_mask is not None:
-            att = att.masked_fill(attention_mask, -np.inf)
-        att = torch.softmax(att, -1)
-        att = self.dropout(att)
-
-        out = torch.matmul(att, v).permute(0, 2, 1, 3).contiguous().view(b_s, nq, self.h * self.d_v)  # (b_s, nq, h*d_v)
+        if self.fused and attention_weights is None:
+            # The fused kernel never materializes the (b_s, h, nq, nk) attention.
+            attn_mask = attention_mask.logical_not() if attention_mask is not None else None
+            out = fused_attention(q, k, v, attn_mask=attn_mask, dropout_p=self.dropout.p if self.training else 0.)
+        else:
+            att = torch.matmul(q, k.transpose(-2, -1)) / np.sqrt(self.d_k)  # (b_s, h, nq, nk)
+            if attention_weights is not None:
+                att = att * attention_weights
+            if attention_mask is not None:
+                att = att.masked_fill(attention_mask, -np.inf)
+            att = torch.softmax(att, -1)
+            att = self.dropout(att)
+            out = torch.matmul(att, v)
+        out = out.permute(0, 2, 1, 3).contiguous().view(b_s, nq, self.h * self.d_v)  # (b_s, nq, h*d_v)
         out = self.fc_o(out).view(B, C, H, W)  # (b_s, nq, d_model)
         return out
 
@@ -334,11 +425,13 @@ class NonLocal(nn.Module):
         if sub_sample:
             self.g = nn.Sequential(self.g, nn.MaxPool2d(kernel_size=(2, 2)))
             self.phi = nn.Sequential(self.phi, nn.MaxPool2d(kernel_size=(2, 2)))
+        self.fused = config.fused_attention
 
-    def forward(self, x, return_nl_map=False):
+    def forward(self, x, return_nl_map=False, group_idx=None):
         """
         :param x: (b, c, t, h, w)
         :param return_nl_map: if True return z, nl_map, else only return z.
+        :param group_idx: Unused, attention is computed within each image.
         :return:
         """
 
@@ -350,10 +443,14 @@ class NonLocal(nn.Module):
         theta_x = self.theta(x).view(batch_size, self.inter_channels, -1)
         theta_x = theta_x.permute(0, 2, 1)
         phi_x = self.phi(x).view(batch_size, self.inter_channels, -1)
-        f = torch.matmul(theta_x, phi_x)
-        f_div_C = F.softmax(f, dim=-1)
+        if self.fused and not return_nl_map:
+            # softmax(theta_x @ phi_x) @ g_x without materializing f_div_C, no scaling as below.
+            y = fused_attention(theta_x, phi_x.permute(0, 2, 1), g_x, scale=1.)
+        else:
+            f = torch.matmul(theta_x, phi_x)
+            f_div_C = F.softmax(f, dim=-1)
 
-        y = torch.matmul(f_div_C, g_x)
+            y = torch.matmul(f_div_C, g_x)
         y = y.permute(0, 2, 1).contiguous()
         y = y.view(batch_size, self.inter_channels, *x.size()[2:])
         W_y = self.W(y)
@@ -364,24 +461,39 @@ class NonLocal(nn.Module):
         return z
 
 
+def fused_attention(q, k, v, attn_mask=None, dropout_p=0., scale=None):
+    # softmax(q @ k^T * scale) @ v, by the flash / memory-efficient kernels of scaled_dot_product_attention (PyTorch >= 2.0),
+    # so memory is linear in the sequence length. attn_mask: True to take part in attention.
+    if hasattr(F, 'scaled_dot_product_attention'):
+        if scale is not None:
+            # Its scale= argument only exists from PyTorch 2.1, q is scaled instead against its default 1/sqrt(d).
+            q = q * (scale * q.shape[-1] ** 0.5)
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+    att = torch.matmul(q, k.transpose(-2, -1)) * (q.shape[-1] ** -0.5 if scale is None else scale)
+    if attn_mask is not None:
+        att = att.masked_fill(attn_mask.logical_not(), -np.inf)
+    att = F.dropout(torch.softmax(att, -1), p=dropout_p)
+    return torch.matmul(att, v)
+
+
 class DBHead(nn.Module):
     def __init__(self, channel_in=32, channel_out=1, k=config.db_k):
         super().__init__()
         self.k = k
         self.binarize = nn.Sequential(
             nn.Conv2d(channel_in, channel_in, 3, 1, 1),
-            *[nn.BatchNorm2d(channel_in), nn.ReLU(inplace=True)] if config.use_bn else nn.ReLU(inplace=True),
+            *([nn.BatchNorm2d(channel_in), nn.ReLU(inplace=True)] if config.use_bn else [nn.ReLU(inplace=True)]),
             nn.Conv2d(channel_in, channel_in, 3, 1, 1),
-            *[nn.BatchNorm2d(channel_in), nn.ReLU(inplace=True)] if config.use_bn else nn.ReLU(inplace=True),
+            *([nn.BatchNorm2d(channel_in), nn.ReLU(inplace=True)] if config.use_bn else [nn.ReLU(inplace=True)]),
             nn.Conv2d(channel_in, channel_out, 1, 1, 0),
             nn.Sigmoid()
         )
 
         self.thresh = nn.Sequential(
             nn.Conv2d(channel_in, channel_in, 3, padding=1),
-            *[nn.BatchNorm2d(channel_in), nn.ReLU(inplace=True)] if config.use_bn else nn.ReLU(inplace=True),
+            *([nn.BatchNorm2d(channel_in), nn.ReLU(inplace=True)] if config.use_bn else [nn.ReLU(inplace=True)]),
             nn.Conv2d(channel_in, channel_in, 3, 1, 1),
-            *[nn.BatchNorm2d(channel_in), nn.ReLU(inplace=True)] if config.use_bn else nn.ReLU(inplace=True),
+            *([nn.BatchNorm2d(channel_in), nn.ReLU(inplace=True)] if config.use_bn else [nn.ReLU(inplace=True)]),
             nn.Conv2d(channel_in, channel_out, 1, 1, 0),
             nn.Sigmoid()
         )
@@ -396,14 +508,31 @@ class DBHead(nn.Module):
         if config.db_k_alpha != 1:
             z = x - y
             mask_neg_inv = 1 - 2 * (z < 0)
-            a = torch.exp(-self.k * (torch.pow(z * mask_neg_inv + 1e-16, 1/config.k_alpha) * mask_neg_inv))
+            exponent = -self.k * (torch.pow(z * mask_neg_inv + 1e-16, 1/config.k_alpha) * mask_neg_inv)
         else:
-            a = torch.exp(-self.k * (x - y))
-        if torch.isinf(a).any():
-            a = torch.exp(-50 * (x - y))
+            exponent = -self.k * (x - y)
+        # Fall back to k=50 if exp overflows anywhere. Selecting the exponent with torch.where rather than branching
+        # on the data keeps one static graph (tracing, export, torch.compile), and no inf reaches the backward.
+        a = torch.exp(torch.where(torch.isinf(torch.exp(exponent.detach())).any(), -50 * (x - y), exponent))
         return torch.reciprocal(1 + a)
 
 
+def guided_upsample(p, guide, radius=1, eps=1e-2, clamp=False):
+    # Fast guided filter (He & Sun, 2015): fit p ~ A * guide + b locally at the resolution of p,
+    # then upsample A and b instead of p, so the edges of the upsampled p follow those of guide.
+    # The linear fit overshoots at edges, clamp=True keeps a probability map in [0, 1].
+    box = lambda t: F.avg_pool2d(t, 2 * radius + 1, stride=1, padding=radius, count_include_pad=False)
+    guide_low = F.interpolate(guide, size=p.shape[2:], mode='bilinear', align_corners=True)
+    mean_guide, mean_p = box(guide_low), box(p)
+    var_guide = box(guide_low * guide_low) - mean_guide * mean_guide
+    A = (box(guide_low * p) - mean_guide * mean_p) / (var_guide + eps)
+    b = mean_p - A * mean_guide
+    A = F.interpolate(box(A), size=guide.shape[2:], mode='bilinear', align_corners=True)
+    b = F.interpolate(box(b), size=guide.shape[2:], mode='bilinear', align_corners=True)
+    out = A * guide + b
+    return out.clamp(0, 1) if clamp else out
+
+
 class RefUnet(nn.Module):
     # Refinement
     def __init__(self, in_ch, inc_ch):
@@ -512,5 +641,6 @@ class RefUnet(nn.Module):
             x = self.db_output_refiner(d1)
         else:
             residual = self.conv_d0(d1)
-            x = x + residual
+            # The coarse map is the last input channel (refine=4: image and map).
+            x = x[:, -1:] + residual
         return x
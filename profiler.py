@@ -0,0 +1,143 @@
+import json
+import time
+from collections import OrderedDict
+import torch
+
+
+def profiled_stages(model):
+    # Stages of GCoNet_plus.forward in execution order, only those the current config builds.
+    names = ['bb.conv{}'.format(idx) for idx in range(1, 6)] + ['avgpool', 'classifier', 'co_x5', 'pred_layer', 'top_layer']
+    for idx in range(5, 1, -1):
+        names += ['enlayer{}'.format(idx), 'dslayer{}'.format(idx), 'conv_out{}'.format(idx), 'latlayer{}'.format(idx)]
+    names += ['enlayer1', 'db_output_decoder', 'conv_out1', 'refiner', 'db_mask', 'conv_out_mask', 'conv_cat_mask']
+    modules = dict(model.named_modules())
+    return [name for name in names if name in modules]
+
+
+class StageProfiler():
+    """
+    Opt-in per-stage profiling of GCoNet_plus with forward hooks, e.g.
+
+        with StageProfiler(model) as profiler:
+            model(inputs)
+        print(profiler.summary())
+        profiler.export_chrome_trace('trace.json')
+
+    Each call of a stage records its wall time, FLOPs (torch.utils.flop_counter, 2 per multiply-add)
+    and the size of its output activations, together with the index of the forward (i.e. group).
+    Backbone stages called again by the cls_mask branch are recorded as 'cls_mask/bb.convX'.
+    Only the forward is covered. On CUDA the device is synchronized around every stage, which
+    makes the timings accurate but the profiled forward slower than a normal one.
+    """
+    def __init__(self, model, flops=True):
+        self.model = model
+        self.flops = flops
+        self.records = []
+        self.forwards = []
+        self.handles = []
+        self.in_forward = False
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def attach(self):
+        self.handles.append(self.model.register_forward_pre_hook(self._forward_pre_hook))
+        self.handles.append(self.model.register_forward_hook(self._forward_hook))
+        for name in profiled_stages(self.model):
+            module = self.model.get_submodule(name)
+            self.handles.append(module.register_forward_pre_hook(lambda m, ipt, name=name: self._stage_pre_hook(name, ipt)))
+            self.handles.append(module.register_forward_hook(lambda m, ipt, opt, name=name: self._stage_hook(name, opt)))
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _now(self, tensors):
+        tensor = next((tensor for tensor in tensors if torch.is_tensor(tensor)), None)
+        if tensor is not None and tensor.is_cuda:
+            torch.cuda.synchronize(tensor.device)
+        return time.perf_counter()
+
+    def _forward_pre_hook(self, module, inputs):
+        self.called = set()
+        self.in_forward = True
+        self.forwards.append({'forward': len(self.forwards), 'num_images': inputs[0].shape[0], 'start': self._now(inputs)})
+
+    def _forward_hook(self, module, inputs, outputs):
+        forward = self.forwards[-1]
+        forward['duration'] = self._now(inputs) - forward['start']
+        self.in_forward = False
+
+    def _stage_pre_hook(self, name, inputs):
+        # Stages recomputed in backward (Config.checkpoint_stages) are not part of the forward.
+        if not self.in_forward:
+            return
+        self.stage_start = self._now(inputs)
+        self.flop_counter = None
+        if self.flops:
+            from torch.utils.flop_counter import FlopCounterMode
+            self.flop_counter = FlopCounterMode(display=False)
+            self.flop_counter.__enter__()
+
+    def _stage_hook(self, name, outputs):
+        if not self.in_forward:
+            return
+        outputs = outputs if isinstance(outputs, (list, tuple)) else [outputs]
+        if self.flop_counter is not None:
+            self.flop_counter.__exit__(None, None, None)
+        duration = self._now(outputs) - self.stage_start
+        # A stage seen twice in the same forward is the backbone run again on the masked features.
+        stage = 'cls_mask/' + name if name in self.called else name
+        self.called.add(name)
+        self.records.append({
+            'forward': self.forwards[-1]['forward'] if self.forwards else 0,
+            'stage': stage,
+            'start': self.stage_start,
+            'duration': duration,
+            'flops': self.flop_counter.get_total_flops() if self.flop_counter is not None else None,
+            'activation_bytes': sum(output.numel() * output.element_size() for output in outputs if torch.is_tensor(output)),
+        })
+
+    def stage_totals(self):
+        totals = OrderedDict()
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'calls': 0, 'duration': 0., 'flops': 0, 'activation_bytes': 0})
+            total['calls'] += 1
+            total['duration'] += record['duration']
+            total['flops'] += record['flops'] or 0
+            total['activation_bytes'] += record['activation_bytes']
+        return totals
+
+    def summary(self):
+        forward_time = sum(forward.get('duration', 0.) for forward in self.forwards)
+        num_images = sum(forward['num_images'] for forward in self.forwards)
+        lines = ['{:<22s} | {:>5s} | {:>10s} | {:>8s} | {:>6s} | {:>9s} | {:>14s}'.format(
+            'stage', 'calls', 'total (ms)', 'mean (ms)', '%', 'GFLOPs', 'activation (MB)')]
+        for stage, total in self.stage_totals().items():
+            lines.append('{:<22s} | {:5d} | {:10.1f} | {:9.2f} | {:6.1f} | {:9.2f} | {:15.1f}'.format(
+                stage, total['calls'], total['duration'] * 1e3, total['duration'] / total['calls'] * 1e3,
+                total['duration'] / max(forward_time, 1e-12) * 100, total['flops'] / 1e9, total['activation_bytes'] / total['calls'] / 1024 ** 2))
+        lines.append('{} forwards, {} images, {:.1f} ms per forward, {:.1f} ms per image.'.format(
+            len(self.forwards), num_images, forward_time / max(len(self.forwards), 1) * 1e3, forward_time / max(num_images, 1) * 1e3))
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, path):
+        # Open in chrome://tracing or https://ui.perfetto.dev, one slice per forward with its stages below it.
+        time_st = self.forwards[0]['start'] if self.forwards else 0.
+        events = [{
+            'name': 'forward', 'ph': 'X', 'pid': 0, 'tid': 0,
+            'ts': (forward['start'] - time_st) * 1e6, 'dur': forward.get('duration', 0.) * 1e6,
+            'args': {'forward': forward['forward'], 'num_images': forward['num_images']},
+        } for forward in self.forwards]
+        events += [{
+            'name': record['stage'], 'ph': 'X', 'pid': 0, 'tid': 0,
+            'ts': (record['start'] - time_st) * 1e6, 'dur': record['duration'] * 1e6,
+            'args': {'forward': record['forward'], 'flops': record['flops'], 'activation_bytes': record['activation_bytes']},
+        } for record in self.records]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,108 @@
+import os
+import copy
+import argparse
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from dataset import get_loader
+from models.GCoNet_plus import GCoNet_plus
+from export import InferenceWrapper, compare_latency
+from test import evaluate
+from config import Config
+
+
+def quantizable_layers(model):
+    # Encoder, decoder ResBlks and lateral 1x1 convs. CoAttLayer, DBHead and the output convs stay in float.
+    names = ['bb.conv{}'.format(idx) for idx in range(1, 6)]
+    names += ['top_layer'] + ['enlayer{}'.format(idx) for idx in range(1, 6)] + ['latlayer{}'.format(idx) for idx in range(2, 6)]
+    names += [name for name in ['dslayer{}'.format(idx) for idx in range(2, 6)] if hasattr(model, name)]
+    return names
+
+
+def set_submodule(model, name, module):
+    parent_name, _, child_name = name.rpartition('.')
+    setattr(model.get_submodule(parent_name) if parent_name else model, child_name, module)
+
+
+def quantize_model(model, calib_loader, num_calib_groups=8, backend='x86'):
+    """
+    Post-training static quantization of the layers in `quantizable_layers`.
+    Each layer is traced with FX on its own, so it takes and returns float tensors and
+    the rest of the model runs unchanged in float around it.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    layer_names = quantizable_layers(model)
+
+    # One forward to get example inputs of every layer for tracing.
+    example_inputs = {}
+    hooks = [
+        model.get_submodule(name).register_forward_pre_hook(lambda m, ipt, name=name: example_inputs.setdefault(name, ipt))
+        for name in layer_names
+    ]
+    calib_batches = [batch for _, batch in zip(range(num_calib_groups), calib_loader)]
+    with torch.no_grad():
+        model(calib_batches[0][0], group_idx=calib_batches[0][4])
+    for hook in hooks:
+        hook.remove()
+
+    for name in layer_names:
+        set_submodule(model, name, prepare_fx(model.get_submodule(name), qconfig_mapping, example_inputs[name]))
+    # Calibrate the observers on real groups.
+    with torch.no_grad():
+        for batch in calib_batches:
+            model(batch[0], group_idx=batch[4])
+    for name in layer_names:
+        set_submodule(model, name, convert_fx(model.get_submodule(name)))
+    return model
+
+
+def main(args):
+    config = Config()
+    model = GCoNet_plus(bb_pretrained=False)
+    model.load_state_dict(torch.load(args.ckpt, map_location='cpu'))
+    model.eval()
+
+    test_img_path = os.path.join(args.root_dir, 'images', args.testset)
+    test_gt_path = os.path.join(args.root_dir, 'gts', args.testset)
+    test_loader = get_loader(test_img_path, test_gt_path, args.size, 1, istrain=False, shuffle=False, num_workers=8, max_batch=args.max_batch)
+
+    model_int8 = quantize_model(model, test_loader, num_calib_groups=args.calib_groups)
+    if args.output:
+        from export import export_torchscript
+        export_torchscript(model_int8, args.output, args.size)
+        print('Saved the quantized model to {}.'.format(args.output))
+
+    apply_sigmoid = not (config.db_output_refiner or (not config.refine and config.db_output_decoder))
+    s_measure, e_max = evaluate(InferenceWrapper(model), test_loader, os.path.join(args.pred_dir, 'fp32', args.testset), test_gt_path, apply_sigmoid)
+    s_measure_int8, e_max_int8 = evaluate(InferenceWrapper(model_int8), test_loader, os.path.join(args.pred_dir, 'int8', args.testset), test_gt_path, apply_sigmoid)
+    latency_fp32, latency_int8 = compare_latency(model, InferenceWrapper(model_int8), args.size)
+    print('{}: S-measure {:.4f} -> {:.4f} ({:+.4f}), E-max {:.4f} -> {:.4f} ({:+.4f}).'.format(
+        args.testset, s_measure, s_measure_int8, s_measure_int8 - s_measure, e_max, e_max_int8, e_max_int8 - e_max))
+    print('CPU latency per group of 8: fp32 {:.1f} ms, int8 {:.1f} ms, speedup x{:.2f}.'.format(
+        latency_fp32 * 1e3, latency_int8 * 1e3, latency_fp32 / latency_int8))
+
+
+if __name__ == '__main__':
+    # Parameter from command line
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--ckpt', default='./ckpt/GCoNet_plus/final.pth', type=str, help='model weights to quantize')
+    parser.add_argument('--testset',
+                        default='CoCA',
+                        type=str,
+                        help="Options: 'CoCA','CoSal2015','CoSOD3k'")
+    parser.add_argument('--root_dir', default='../../../datasets/sod', type=str, help='dataset root')
+    parser.add_argument('--size',
+                        default=224,
+                        type=int,
+                        help='input size')
+    parser.add_argument('--calib_groups', default=8, type=int, help='number of test groups used for calibration')
+    parser.add_argument('--max_batch', default=1, type=int, help='max number of images per forward pass')
+    parser.add_argument('--pred_dir', default='/root/datasets/sod/preds/GCoNet_plus_quant', type=str, help='Output folder')
+    parser.add_argument('--output', default='', type=str, help='save the int8 model as TorchScript if given')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,34 +1,80 @@
 import os
+import json
+import time
+import shutil
 import argparse
+import tempfile
+import subprocess
 from tqdm import tqdm
+import numpy as np
+from PIL import Image
 import torch
 from torch import nn
 
-from dataset import get_loader
+from dataset import get_loader, CoData, GroupBucketSampler, collate_groups
 from models.GCoNet_plus import GCoNet_plus
-from util import save_tensor_img
+from models.fusion import fold_batchnorm
+from export import InferenceWrapper
+from deploy import load_runner
+from profiler import StageProfiler
+from util import CompiledModule, PredictionWriter, unwrap_model
 from config import Config
+from evaluation.dataloader import EvalDataset
+from evaluation.evaluator import Eval_thread
 
 
 def main(args):
     # Init model
     config = Config()
 
-    device = torch.device("cuda")
-    model = GCoNet_plus()
-    model = model.to(device)
     print('Testing with model {}'.format(args.ckpt))
-    gconet_dict = torch.load(args.ckpt)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.backend == 'torch':
+        device = torch.device(args.device)
+        # Backbone weights come from the checkpoint, no need for the ImageNet ones.
+        model = GCoNet_plus(bb_pretrained=False)
+        gconet_dict = torch.load(args.ckpt, map_location=device)
 
-    model.to(device)
-    model.load_state_dict(gconet_dict)
+        model.to(device)
+        model.load_state_dict(gconet_dict)
 
-    model.eval()
+        model.eval()
+        if args.output_stride:
+            model.config.output_stride, model.config.output_guided = args.output_stride, args.guided
+        if args.fuse:
+            model = fold_batchnorm(model)
+        if args.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        if args.ipex:
+            # Optional Intel Extension for PyTorch, oneDNN graph and weight prepacking for CPU.
+            import intel_extension_for_pytorch as ipex
+            model = ipex.optimize(model)
+        if args.profile:
+            profiler = StageProfiler(model)
+            profiler.attach()
+        model = InferenceWrapper(model, channels_last=args.channels_last).eval()
+        if args.compile:
+            model = CompiledModule(model)
+        apply_sigmoid = not (config.db_output_refiner or (not config.refine and config.db_output_decoder))
+    else:
+        # Exported model (see export.py), run on CPU with TorchScript or ONNX Runtime.
+        device = torch.device("cpu")
+        model = load_runner(args.ckpt, device=device)
+        apply_sigmoid = model.apply_sigmoid
 
+    # PNG encoding and writing of the predictions in background threads.
+    writer = PredictionWriter(num_workers=args.save_workers, compress_level=args.png_compression)
+    reports = {}
     for testset in args.testsets.split('+'):
         print('Testing {}...'.format(testset))
         root_dir = '../../../datasets/sod'
-        if testset == 'CoCA':
+        synthetic_root = None
+        if testset == 'synthetic':
+            synthetic_root = tempfile.mkdtemp()
+            test_img_path, test_gt_path = synthetic_testset(synthetic_root, args.synthetic_groups, args.synthetic_group_size)
+            saved_root = os.path.join(args.pred_dir, 'synthetic')
+        elif testset == 'CoCA':
             test_img_path = os.path.join(root_dir, 'images/CoCA')
             test_gt_path = os.path.join(root_dir, 'gts/CoCA')
             saved_root = os.path.join(args.pred_dir, 'CoCA')
@@ -45,27 +91,239 @@ def main(args):
             print(args.dataset)
         
         test_loader = get_loader(
-            test_img_path, test_gt_path, args.size, 1, istrain=False, shuffle=False, num_workers=8, pin=True)
+            test_img_path, test_gt_path, args.size, 1, istrain=False, shuffle=False, num_workers=8, pin=True, max_batch=args.max_batch)
 
-        for batch in tqdm(test_loader):
-            inputs = batch[0].to(device).squeeze(0)
-            gts = batch[1].to(device).squeeze(0)
-            subpaths = batch[2]
-            ori_sizes = batch[3]
+        if args.benchmark:
+            reports[testset] = benchmark(
+                model, test_img_path, test_gt_path, saved_root, device, apply_sigmoid, writer, args.size, args.max_batch, warmup=args.benchmark_warmup)
+            print(format_benchmark(testset, reports[testset]))
+        elif args.cascade_size and args.backend == 'torch':
+            early_exits = predict_cascade(
+                model, test_loader, saved_root, device, apply_sigmoid, writer, args.cascade_size, args.cascade_threshold, per_image=args.cascade_level == 'image')
+            print('{}: {:.1%} of the images exited at size {}.'.format(testset, early_exits, args.cascade_size))
+        else:
+            predict(model, test_loader, saved_root, device, apply_sigmoid, writer)
+        if synthetic_root is not None:
+            shutil.rmtree(synthetic_root)
+    writer.close()
+
+    if args.benchmark:
+        with open(args.benchmark, 'w') as f:
+            json.dump({
+                'commit': git_commit(), 'torch': torch.__version__, 'backend': args.backend, 'device': str(device),
+                'num_threads': torch.get_num_threads(), 'size': args.size, 'max_batch': args.max_batch, 'testsets': reports,
+            }, f, indent=2)
+        print('Saved the benchmark to {}.'.format(args.benchmark))
+    if args.compile and args.backend == 'torch':
+        print(model.report())
+    if args.profile and args.backend == 'torch':
+        profiler.detach()
+        print(profiler.summary())
+        profiler.export_chrome_trace(args.profile)
+        print('Saved the Chrome trace to {}.'.format(args.profile))
+
+
+def predict(model, test_loader, saved_root, device, apply_sigmoid, writer):
+    # model(inputs, group_idx) gives the final predictions, e.g. InferenceWrapper or a runner from deploy.py.
+    for batch in tqdm(test_loader):
+        inputs = batch[0].to(device)
+        subpaths = batch[2]
+        ori_sizes = batch[3]
+        group_idx = batch[4].to(device)
+        with torch.no_grad():
+            scaled_preds = model(inputs, group_idx)
+        save_preds(scaled_preds, subpaths, ori_sizes, saved_root, apply_sigmoid, writer)
+
+
+def preds_to_host(scaled_preds, ori_sizes, apply_sigmoid):
+    # uint8 maps at the original sizes, as numpy arrays, with one device to host copy for the whole batch.
+    maps = []
+    for inum in range(len(scaled_preds)):
+        res = nn.functional.interpolate(scaled_preds[inum].unsqueeze(0), size=ori_sizes[inum], mode='bilinear', align_corners=True)
+        if apply_sigmoid:
+            res = res.sigmoid()
+        # Same conversion as ToPILImage, clamped first so that out-of-range values do not wrap around.
+        maps.append(res.clamp(0, 1).mul(255).byte().flatten())
+    maps = torch.cat(maps).cpu().split([int(h) * int(w) for h, w in ori_sizes])
+    return [pred_map.view(int(h), int(w)).numpy() for pred_map, (h, w) in zip(maps, ori_sizes)]
+
+
+def save_preds(scaled_preds, subpaths, ori_sizes, saved_root, apply_sigmoid, writer):
+    for subpath in subpaths:
+        os.makedirs(os.path.join(saved_root, subpath.split('/')[0]), exist_ok=True)
+    for subpath, pred_map in zip(subpaths, preds_to_host(scaled_preds, ori_sizes, apply_sigmoid)):
+        writer.write(pred_map, os.path.join(saved_root, subpath))
+
+
+def decoder_db_maps(model):
+    """
+    Hooks on the shrink (P) and threshold (T) maps of the DBHead on the decoder output of the GCoNet_plus inside model
+    (InferenceWrapper, CompiledModule), filled by every forward. Returns the dict of maps and the hook handles, or
+    (None, []) without such a DBHead. The hooks stay registered for the whole run, so a compiled model keeps one graph.
+    """
+    db_head = getattr(unwrap_model(model), 'db_output_decoder', None)
+    if db_head is None:
+        return None, []
+    maps = {}
+    handles = [
+        db_head.binarize.register_forward_hook(lambda m, ipt, opt: maps.__setitem__('shrink', opt)),
+        db_head.thresh.register_forward_hook(lambda m, ipt, opt: maps.__setitem__('thresh', opt)),
+    ]
+    return maps, handles
+
+
+def image_confidence(scaled_preds, db_maps, apply_sigmoid):
+    """
+    Per-image confidence in [0, 1], the mean pixel margin from the 0.5 decision.
+    With a DBHead on the decoder output it is |P - T| of its shrink and threshold maps (db_maps): its binarization
+    sigmoid(k * (P - T)) with k=300 is saturated once |P - T| > 0.01, so |2p - 1| of the prediction p would be ~1 everywhere.
+    Otherwise |2p - 1| of the prediction p.
+    """
+    if db_maps is not None:
+        confidence = (db_maps['shrink'] - db_maps['thresh']).abs()
+    else:
+        confidence = (2 * (scaled_preds.sigmoid() if apply_sigmoid else scaled_preds) - 1).abs()
+    return confidence.mean(dim=(1, 2, 3))
+
+
+def predict_cascade(model, test_loader, saved_root, device, apply_sigmoid, writer, low_size, threshold, per_image=False):
+    """
+    Run each batch at low_size first, keep the predictions of the confident groups (per_image: images) and run
+    only the others again at the loader size. Re-run images are grouped with the other re-run images of their group,
+    so with per_image their consensus comes from that subset only. Returns the fraction of images that exited early.
+    """
+    db_maps, handles = decoder_db_maps(model)
+    num_images, num_early = 0, 0
+    for batch in tqdm(test_loader):
+        inputs = batch[0].to(device)
+        subpaths = batch[2]
+        ori_sizes = batch[3]
+        group_idx = batch[4].to(device)
+        inputs_low = nn.functional.interpolate(inputs, size=(low_size, low_size), mode='bilinear', align_corners=True)
+        with torch.no_grad():
+            scaled_preds = model(inputs_low, group_idx)
+        confidence = image_confidence(scaled_preds, db_maps, apply_sigmoid)
+        if not per_image:
+            # Mean confidence of the group of each image.
+            group_mask = (group_idx.unsqueeze(1) == group_idx.unsqueeze(0)).to(confidence.dtype)
+            confidence = torch.matmul(group_mask, confidence) / group_mask.sum(-1)
+        rerun = (confidence < threshold).nonzero().squeeze(1)
+        # Low-res predictions are kept as they are, save_preds upsamples all to the original sizes anyway.
+        scaled_preds = list(scaled_preds)
+        if len(rerun):
             with torch.no_grad():
-                scaled_preds = model(inputs)[-1]
+                preds_rerun = model(inputs[rerun], group_idx[rerun])
+            for idx, pred in zip(rerun.tolist(), preds_rerun):
+                scaled_preds[idx] = pred
+        save_preds(scaled_preds, subpaths, ori_sizes, saved_root, apply_sigmoid, writer)
+        num_images += len(subpaths)
+        num_early += len(subpaths) - len(rerun)
+    for handle in handles:
+        handle.remove()
+    return num_early / max(num_images, 1)
+
 
-            os.makedirs(os.path.join(saved_root, subpaths[0][0].split('/')[0]), exist_ok=True)
+def synthetic_testset(root, num_groups, group_size, image_size=(300, 400)):
+    # Smooth random JPEG images and PNG masks in the layout of the test sets, to run test.py without a dataset.
+    rng = np.random.RandomState(0)
+    for idx_group in range(num_groups):
+        group = 'group{}'.format(idx_group)
+        os.makedirs(os.path.join(root, 'images', group), exist_ok=True)
+        os.makedirs(os.path.join(root, 'gts', group), exist_ok=True)
+        for idx in range(group_size):
+            image = Image.fromarray(rng.randint(0, 256, (image_size[0] // 8, image_size[1] // 8, 3), dtype=np.uint8))
+            image.resize(image_size[::-1], Image.BILINEAR).save(os.path.join(root, 'images', group, '{}.jpg'.format(idx)))
+            mask = Image.fromarray((rng.rand(image_size[0] // 8, image_size[1] // 8) > 0.5).astype(np.uint8) * 255)
+            mask.resize(image_size[::-1], Image.NEAREST).save(os.path.join(root, 'gts', group, '{}.png'.format(idx)))
+    return os.path.join(root, 'images'), os.path.join(root, 'gts')
 
-            num = len(scaled_preds)
-            for inum in range(num):
-                subpath = subpaths[inum][0]
-                ori_size = (ori_sizes[inum][0].item(), ori_sizes[inum][1].item())
-                if config.db_output_refiner or (not config.refine and config.db_output_decoder):
-                    res = nn.functional.interpolate(scaled_preds[inum].unsqueeze(0), size=ori_size, mode='bilinear', align_corners=True)
-                else:
-                    res = nn.functional.interpolate(scaled_preds[inum].unsqueeze(0), size=ori_size, mode='bilinear', align_corners=True).sigmoid()
-                save_tensor_img(res, os.path.join(saved_root, subpath))
+
+benchmark_stages = ['decode', 'preprocess', 'h2d', 'forward', 'interpolate', 'encode']
+
+
+def benchmark(model, test_img_path, test_gt_path, saved_root, device, apply_sigmoid, writer, size, max_batch, warmup=1):
+    """
+    The test pipeline of predict() run in the main process, batch by batch (groups packed up to max_batch images),
+    with the time of each stage: image decoding and preprocessing (CoData), host to device copy, forward,
+    interpolation back to the original sizes with the device to host copy (preds_to_host) and the PNG writes
+    (the time the main thread spends in writer.write, the whole encoding without writer threads). CUDA is synchronized
+    after each stage. The first warmup batches are left out of the report, the writes still pending after the last
+    batch are timed apart ('drain_ms').
+    """
+    dataset = CoData(test_img_path, test_gt_path, size, float('inf'), is_train=False)
+    dataset.timings = {}
+    group_sizes = [len(os.listdir(image_dir)) for image_dir in dataset.image_dirs]
+
+    def now():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        return time.perf_counter()
+
+    records = []
+    for idx_batch, bucket in enumerate(tqdm(GroupBucketSampler(group_sizes, max_batch))):
+        dataset.timings.clear()
+        inputs, _, subpaths, ori_sizes, group_idx = collate_groups([dataset[item] for item in bucket])
+        timings = dict(dataset.timings)
+        time_st = now()
+        inputs, group_idx = inputs.to(device), group_idx.to(device)
+        time_h2d = now()
+        with torch.no_grad():
+            scaled_preds = model(inputs, group_idx)
+        time_forward = now()
+        pred_maps = preds_to_host(scaled_preds, ori_sizes, apply_sigmoid)
+        time_interpolate = now()
+        for subpath, pred_map in zip(subpaths, pred_maps):
+            os.makedirs(os.path.join(saved_root, subpath.split('/')[0]), exist_ok=True)
+            writer.write(pred_map, os.path.join(saved_root, subpath))
+        time_encode = now()
+        timings.update(h2d=time_h2d - time_st, forward=time_forward - time_h2d, interpolate=time_interpolate - time_forward, encode=time_encode - time_interpolate)
+        if idx_batch >= warmup:
+            records.append(dict(images=len(subpaths), **timings))
+    time_st = now()
+    writer.wait()
+    time_drain = now() - time_st
+
+    latencies = np.array([sum(record.get(stage, 0.) for stage in benchmark_stages) for record in records])
+    num_images = sum(record['images'] for record in records)
+    return {
+        'batches': len(records),
+        'images': num_images,
+        'imgs_per_s': num_images / max(latencies.sum(), 1e-12),
+        'latency_ms': {
+            'mean': latencies.mean() * 1e3, 'p50': np.percentile(latencies, 50) * 1e3,
+            'p95': np.percentile(latencies, 95) * 1e3, 'p99': np.percentile(latencies, 99) * 1e3,
+        } if len(records) else {},
+        # Mean per batch.
+        'stages_ms': {stage: np.mean([record.get(stage, 0.) for record in records]) * 1e3 if len(records) else 0. for stage in benchmark_stages},
+        'drain_ms': time_drain * 1e3,
+    }
+
+
+def format_benchmark(testset, report):
+    lines = ['{}: {} batches, {} images, {:.2f} imgs/s, latency per batch (ms): {}'.format(
+        testset, report['batches'], report['images'], report['imgs_per_s'],
+        ', '.join('{} {:.1f}'.format(key, value) for key, value in report['latency_ms'].items()))]
+    total = sum(report['stages_ms'].values())
+    for stage, value in report['stages_ms'].items():
+        lines.append('    {:<12s} {:9.2f} ms {:6.1f} %'.format(stage, value, value / max(total, 1e-12) * 100))
+    lines.append('    pending writes drained in {:.1f} ms after the last batch'.format(report['drain_ms']))
+    return '\n'.join(lines)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def evaluate(model, test_loader, saved_root, gt_root, apply_sigmoid):
+    # Predict on CPU and return the S-measure and max E-measure of the predictions.
+    writer = PredictionWriter()
+    predict(model, test_loader, saved_root, torch.device('cpu'), apply_sigmoid, writer)
+    writer.close()
+    evaler = Eval_thread(EvalDataset(saved_root, gt_root), cuda=False)
+    return evaler.Eval_Smeasure(), evaler.Eval_Emeasure().max().item()
 
 
 if __name__ == '__main__':
@@ -78,11 +336,37 @@ if __name__ == '__main__':
     parser.add_argument('--testsets',
                        default='CoCA+CoSOD3k+CoSal2015',
                        type=str,
-                       help="Options: 'CoCA','CoSal2015','CoSOD3k','iCoseg','MSRC'")
+                       help="Options: 'CoCA','CoSal2015','CoSOD3k','iCoseg','MSRC', 'synthetic'")
     parser.add_argument('--size',
                         default=224,
                         type=int,
                         help='input size')
+    parser.add_argument('--max_batch',
+                        default=1,
+                        type=int,
+                        help='max number of images per forward pass, small groups are packed together up to it')
+    parser.add_argument('--backend',
+                        default='torch',
+                        type=str,
+                        help="Options: 'torch', 'torchscript', 'onnx' (--ckpt is then a file from export.py)")
+    parser.add_argument('--output_stride', default=0, type=int, help='run the output head at 1/output_stride of the input size (torch backend), Config.output_stride if 0')
+    parser.add_argument('--guided', action='store_true', help='with --output_stride, upsample with a fast guided filter')
+    parser.add_argument('--cascade_size', default=0, type=int, help='run at this size first and only re-run the unconfident groups at --size (torch backend), off if 0')
+    parser.add_argument('--cascade_threshold', default=0.3, type=float, help='mean confidence (see image_confidence) below which a group/image is re-run')
+    parser.add_argument('--cascade_level', default='group', type=str, help="Options: 'group', 'image'")
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str, help="Options: 'cuda', 'cpu' (torch backend)")
+    parser.add_argument('--threads', default=0, type=int, help='number of CPU threads, PyTorch default if 0')
+    parser.add_argument('--channels_last', action='store_true', help='NHWC model and inputs (torch backend), faster convs on CPU')
+    parser.add_argument('--ipex', action='store_true', help='optimize the model with intel_extension_for_pytorch (torch backend on CPU)')
+    parser.add_argument('--compile', action='store_true', help='run the model with torch.compile (torch backend)')
+    parser.add_argument('--fuse', action='store_true', help='fold BN into the convs for faster inference (torch backend)')
+    parser.add_argument('--profile', default='', type=str, help='profile the stages of the model (torch backend) and save a Chrome trace here')
+    parser.add_argument('--save_workers', default=4, type=int, help='threads encoding and writing the PNG predictions, 0 to write them synchronously')
+    parser.add_argument('--png_compression', default=6, type=int, help='PNG compression level of the predictions, 0 (fastest) to 9 (smallest)')
+    parser.add_argument('--benchmark', default='', type=str, help='time the stages of the test pipeline per batch and save the report (JSON) here')
+    parser.add_argument('--benchmark_warmup', default=1, type=int, help='batches left out of the benchmark')
+    parser.add_argument('--synthetic_groups', default=20, type=int, help="number of groups of the 'synthetic' test set (random images, no dataset needed)")
+    parser.add_argument('--synthetic_group_size', default=8, type=int)
     parser.add_argument('--ckpt', default='./ckpt/GCoNet_plus/final.pth', type=str, help='model folder')
     parser.add_argument('--pred_dir', default='/root/datasets/sod/preds/GCoNet_plus', type=str, help='Output folder')
 
@@ -0,0 +1,7 @@
+import os
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# The tests import the modules of the repo root and run from it like the scripts, Config() reads gco.sh there.
+sys.path.insert(0, root)
+os.chdir(root)
@@ -0,0 +1,106 @@
+import torch
+from torch import nn
+
+from loss import pairwise_distance_torch, IoU_loss, SSIMLoss, ThrReg_loss, SaliencyLoss
+
+
+# Reference implementations for the parity tests (and benchmarks/), the code the optimized versions replaced.
+
+
+def triplet_semi_hard_loss_tiled(y_pred, y_true, margin=1.0):
+    # The former TripletSemiHardLoss with B^2 x B tiles, kept as the reference for the parity check.
+    labels, embeddings = y_true, y_pred
+    labels = torch.reshape(labels, [labels.shape[0], 1])
+    pdist_matrix = pairwise_distance_torch(embeddings)
+    adjacency = torch.eq(labels, labels.transpose(0, 1))
+    adjacency_not = adjacency.logical_not()
+    batch_size = labels.shape[0]
+
+    pdist_matrix_tile = pdist_matrix.repeat(batch_size, 1)
+    adjacency_not_tile = adjacency_not.repeat(batch_size, 1)
+    transpose_reshape = pdist_matrix.transpose(0, 1).reshape(-1, 1)
+    greater = pdist_matrix_tile > transpose_reshape
+    mask = adjacency_not_tile & greater
+    mask_final = (mask.to(dtype=torch.float32).sum(axis=1) > 0.0).reshape(batch_size, batch_size).transpose(0, 1)
+    adjacency_not = adjacency_not.to(dtype=torch.float32)
+    mask = mask.to(dtype=torch.float32)
+
+    axis_maximums = torch.max(pdist_matrix_tile, dim=1, keepdim=True)
+    masked_minimums = torch.min(torch.mul(pdist_matrix_tile - axis_maximums[0], mask), dim=1, keepdim=True)[0] + axis_maximums[0]
+    negatives_outside = masked_minimums.reshape([batch_size, batch_size]).transpose(0, 1)
+    axis_minimums = torch.min(pdist_matrix, dim=1, keepdim=True)
+    masked_maximums = torch.max(torch.mul(pdist_matrix - axis_minimums[0], adjacency_not), dim=1, keepdim=True)[0] + axis_minimums[0]
+    negatives_inside = masked_maximums.repeat(1, batch_size)
+    semi_hard_negatives = torch.where(mask_final, negatives_outside, negatives_inside)
+
+    loss_mat = margin + pdist_matrix - semi_hard_negatives
+    mask_positives = adjacency.to(dtype=torch.float32) - torch.diag(torch.ones(batch_size, device=embeddings.device))
+    num_positives = mask_positives.sum()
+    triplet_loss = (torch.max(torch.mul(loss_mat, mask_positives), torch.tensor([0.], device=embeddings.device))).sum() / num_positives
+    return triplet_loss.to(dtype=embeddings.dtype)
+
+
+def corpus(num_cases, seed=0):
+    # Random l2-normalized embeddings: several group sizes, numbers of classes, margins, duplicated embeddings.
+    generator = torch.Generator().manual_seed(seed)
+    for case in range(num_cases):
+        batch_size = int(torch.randint(2, 64, (1, ), generator=generator))
+        num_classes = int(torch.randint(1, min(batch_size, 8) + 1, (1, ), generator=generator))
+        embeddings = torch.nn.functional.normalize(torch.randn(batch_size, 16, generator=generator), dim=1)
+        if case % 4 == 0:
+            embeddings[batch_size // 2:] = embeddings[:batch_size - batch_size // 2].clone()
+        labels = torch.randint(0, num_classes, (batch_size, ), generator=generator)
+        yield embeddings, labels, [0.1, 1.0][case % 2], case % 4 == 0
+
+
+def criterions_loop(lambdas, criteria=('bce', 'iou', 'ssim', 'mse', 'reg')):
+    # The former DSLoss criteria, one module per loss, kept as the reference for the parity check.
+    modules = {'bce': nn.BCELoss, 'iou': IoU_loss, 'ssim': SSIMLoss, 'mse': nn.MSELoss, 'reg': ThrReg_loss}
+    criterions = {name: modules[name]() for name, weight in lambdas.items() if name in criteria and weight}
+
+    def criterion(pred, gt):
+        loss = 0
+        for name, module in criterions.items():
+            loss += module(pred, gt) * lambdas[name]
+        return loss
+    return criterion
+
+
+def saliency_inputs(group_size, size, levels):
+    # Decoder outputs at 1/16 to 1/1 of the input size, and the GT, like DSLoss receives them.
+    torch.manual_seed(0)
+    gt = (torch.rand(group_size, 1, size, size) > 0.5).float()
+    preds = [torch.randn(group_size, 1, size // 2 ** idx, size // 2 ** idx, requires_grad=True) for idx in range(levels - 1, -1, -1)]
+    return preds, gt
+
+
+def parity(lambdas, group_size, size, levels):
+    results = []
+    for criterion in [criterions_loop(lambdas), SaliencyLoss(lambdas)]:
+        preds, gt = saliency_inputs(group_size, size, levels)
+        loss = 0
+        for pred in preds:
+            loss += criterion(nn.functional.interpolate(pred, size=gt.shape[2:], mode='bilinear', align_corners=True).sigmoid(), gt)
+        loss.backward()
+        results.append((loss.detach(), [pred.grad for pred in preds]))
+    (loss_loop, grads_loop), (loss_fused, grads_fused) = results
+    return (loss_loop - loss_fused).abs().item(), max((grad_loop - grad_fused).abs().max().item() for grad_loop, grad_fused in zip(grads_loop, grads_fused))
+
+
+def ds_saliency_loss_loop(config, scaled_preds, gt):
+    # The saliency part of the former DSLoss.forward: all criteria on the last output, no 'reg' on the others.
+    criterion_last = criterions_loop(config.lambdas_sal_last)
+    criterion_others = criterions_loop(config.lambdas_sal_others, criteria=('bce', 'iou', 'ssim', 'mse'))
+    loss = 0
+    for idx_output, pred_lvl in enumerate(scaled_preds):
+        if pred_lvl.shape != gt.shape:
+            pred_lvl = nn.functional.interpolate(pred_lvl, size=gt.shape[2:], mode='bilinear', align_corners=True)
+        if idx_output == len(scaled_preds) - 1:
+            if not(config.db_output_refiner or (not config.refine and config.db_output_decoder)):
+                pred_lvl = pred_lvl.sigmoid()
+            loss += criterion_last(pred_lvl, gt)
+        else:
+            if not (config.refine and config.db_output_decoder and idx_output == len(scaled_preds) - 2):
+                pred_lvl = pred_lvl.sigmoid()
+            loss += criterion_others(pred_lvl, gt)
+    return loss
@@ -0,0 +1,39 @@
+import torch
+from torch import nn
+
+from models.GCoNet_plus import GCoNet_plus
+
+
+def flatten(values):
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            yield from flatten(value)
+        else:
+            yield value
+
+
+def train_step(checkpoint_stages):
+    torch.manual_seed(0)
+    model = GCoNet_plus(bb_pretrained=False).train()
+    model.config.checkpoint_stages = checkpoint_stages
+    inputs = torch.randn(2, 3, 64, 64, generator=torch.Generator().manual_seed(1))
+    sum(value.float().mean() for value in flatten(model(inputs))).backward()
+    return model
+
+
+def test_checkpointing_keeps_bn_stats():
+    # One training step with every stage checkpointed: same BN running stats and gradients as without.
+    model_ref = train_step([])
+    model = train_step(['bb', 'decoder', 'refiner', 'cls_mask'])
+    layers = dict(model.named_modules())
+    num_bns = 0
+    for name, layer_ref in model_ref.named_modules():
+        if isinstance(layer_ref, nn.modules.batchnorm._BatchNorm):
+            num_bns += 1
+            assert torch.equal(layers[name].num_batches_tracked, layer_ref.num_batches_tracked), name
+            assert torch.allclose(layers[name].running_mean, layer_ref.running_mean, atol=1e-6), name
+            assert torch.allclose(layers[name].running_var, layer_ref.running_var, atol=1e-6), name
+    assert num_bns
+    for (name, param_ref), param in zip(model_ref.named_parameters(), model.parameters()):
+        if param_ref.grad is not None:
+            assert torch.allclose(param.grad, param_ref.grad, rtol=1e-4, atol=1e-6), name
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from dataset import DistributedGroupSampler, get_loader
+
+
+@pytest.mark.parametrize('num_replicas', [2, 3])
+@pytest.mark.parametrize('num_groups', [1, 2, 3, 4, 5, 7])
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_distributed_group_sampler_lockstep(num_groups, num_replicas, shuffle):
+    samplers = [DistributedGroupSampler(num_groups, num_replicas, rank, shuffle=shuffle, seed=3) for rank in range(num_replicas)]
+    for epoch in range(2):
+        shards = []
+        for sampler in samplers:
+            sampler.set_epoch(epoch)
+            shards.append(list(sampler))
+        # Every rank runs the same number of iterations, every group is seen.
+        for sampler, shard in zip(samplers, shards):
+            assert len(shard) == len(sampler) == sampler.num_samples
+        assert set(index for shard in shards for index in shard) == set(range(num_groups))
+        # Without padding (num_groups a multiple of num_replicas), each group once.
+        if num_groups % num_replicas == 0:
+            assert sorted(index for shard in shards for index in shard) == list(range(num_groups))
+
+
+@pytest.fixture(scope='module')
+def testset(tmp_path_factory):
+    # Three groups of 3, 2 and 4 images in the layout of the test sets.
+    root = tmp_path_factory.mktemp('sod')
+    for group, group_size in [('a', 3), ('b', 2), ('c', 4)]:
+        os.makedirs(root / 'images' / group)
+        os.makedirs(root / 'gts' / group)
+        for idx in range(group_size):
+            Image.fromarray(np.random.randint(0, 255, (40, 50, 3), dtype=np.uint8)).save(root / 'images' / group / '{}.jpg'.format(idx))
+            Image.fromarray(np.random.randint(0, 2, (40, 50), dtype=np.uint8) * 255).save(root / 'gts' / group / '{}.png'.format(idx))
+    return str(root / 'images'), str(root / 'gts')
+
+
+@pytest.mark.parametrize('max_batch', [None, 0, 1, 5])
+def test_test_loader_batches(testset, max_batch):
+    # Test batches always carry group_idx, one group per batch without max_batch.
+    loader = get_loader(*testset, 64, 1, istrain=False, max_batch=max_batch)
+    num_images = 0
+    for batch in loader:
+        assert len(batch) == 5
+        num_images += len(batch[2])
+        if not max_batch or max_batch == 1:
+            assert batch[4].unique().numel() == 1
+    assert num_images == 9
@@ -0,0 +1,35 @@
+import pytest
+import torch
+from torch import nn
+
+from models.GCoNet_plus import GCoNet_plus
+from export import export_torchscript, export_onnx, check_export
+from deploy import load_runner
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    model = GCoNet_plus(bb_pretrained=False)
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.1, 0.1)
+            module.running_var.uniform_(0.5, 1.5)
+    # With the default k=300, the binarization of DBHead saturates the outputs to 0/1 and they say little about
+    # the graph. With k=1 they are sigmoid(P - T), so any deviation of the exported graph shows in them.
+    model.db_output_decoder.k = 1
+    model.eval()
+    return model
+
+
+@pytest.mark.parametrize('export, suffix', [(export_torchscript, '.pt'), (export_onnx, '.onnx')])
+def test_export_parity(model, export, suffix, tmp_path):
+    if suffix == '.onnx':
+        pytest.importorskip('onnx')
+        pytest.importorskip('onnxruntime')
+    path = str(tmp_path / ('model' + suffix))
+    export(model, path, 64)
+    # Group sizes other than the traced one.
+    max_diff, unsaturated = check_export(model, load_runner(path), 64, group_sizes=(1, 3, 7))
+    assert unsaturated > 0.99
+    assert max_diff < 1e-4
@@ -0,0 +1,25 @@
+import copy
+
+import torch
+from torch import nn
+
+from models.GCoNet_plus import GCoNet_plus
+from models.fusion import fold_batchnorm
+
+
+def test_fold_batchnorm_same_outputs():
+    torch.manual_seed(0)
+    model = GCoNet_plus(bb_pretrained=False)
+    # Random running stats, so that the folding is not the identity.
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.1, 0.1)
+            module.running_var.uniform_(0.5, 1.5)
+    model.eval()
+    model_folded = fold_batchnorm(copy.deepcopy(model))
+    assert not any(isinstance(module, nn.BatchNorm2d) for module in model_folded.modules())
+    inputs = torch.randn(3, 3, 64, 64)
+    group_idx = torch.tensor([0, 0, 1])
+    with torch.no_grad():
+        for group in [None, group_idx]:
+            assert torch.allclose(model(inputs, group_idx=group)[-1], model_folded(inputs, group_idx=group)[-1], atol=1e-4)
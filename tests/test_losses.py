@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+import loss
+from loss import TripletSemiHardLoss
+from references import triplet_semi_hard_loss_tiled, corpus, parity, saliency_inputs, ds_saliency_loss_loop
+
+
+def test_triplet_semi_hard_loss_parity():
+    # Against the former tiled mining, on random groups with several classes, margins and tied distances.
+    for embeddings, labels, margin, has_ties in corpus(100):
+        losses, grads = [], []
+        for loss_fn in [triplet_semi_hard_loss_tiled, TripletSemiHardLoss]:
+            embeddings_grad = embeddings.clone().requires_grad_()
+            loss = loss_fn(embeddings_grad, labels, margin=margin)
+            if loss.requires_grad and torch.isfinite(loss):
+                loss.backward()
+            losses.append(loss.detach())
+            grads.append(embeddings_grad.grad if embeddings_grad.grad is not None else torch.zeros_like(embeddings))
+        assert torch.equal(losses[0], losses[1]) or (losses[0].isnan() and losses[1].isnan())
+        # With tied distances, both pick one of the equally distant negatives, but not always the same one.
+        if not has_ties:
+            assert torch.allclose(grads[0], grads[1], atol=1e-6)
+
+
+@pytest.mark.parametrize('lambdas', [
+    {'bce': 30, 'iou': 0.5, 'ssim': 0, 'mse': 0, 'reg': 0},
+    {'bce': 30, 'iou': 0.5, 'ssim': 1, 'mse': 150, 'reg': 100},
+])
+def test_saliency_loss_parity(lambdas):
+    # Against one module per criterion, loss and gradients of the decoder outputs.
+    loss_diff, grad_diff = parity(lambdas, 4, 64, 3)
+    assert loss_diff < 1e-3
+    assert grad_diff < 1e-6
+
+
+def test_ds_loss_reg_parity(monkeypatch):
+    # 'reg' on in both lambdas: DSLoss applies it to the last output only, like the former per-criterion loop.
+    class ConfigReg(loss.Config):
+        def __init__(self):
+            super(ConfigReg, self).__init__()
+            self.lambdas_sal_last.update(bce=30, iou=0.5, ssim=1, mse=150, reg=100, triplet=0)
+            self.lambdas_sal_others.update(bce=30, iou=0.5, ssim=1, mse=150, reg=100)
+    monkeypatch.setattr(loss, 'Config', ConfigReg)
+    preds, gt = saliency_inputs(4, 64, 3)
+    # In [0, 1] for the last output, which gets no sigmoid with the DBHead output.
+    preds = [pred.detach().sigmoid() for pred in preds]
+    loss_ref = ds_saliency_loss_loop(ConfigReg(), preds, gt)
+    assert abs(loss.DSLoss()(preds, gt).item() - loss_ref.item()) < 1e-3
+
+
+def test_ssim_engine_band_matches_separable():
+    # The CPU band matmuls and the grouped separable convs (the path off CPU) give the same moments.
+    torch.manual_seed(0)
+    x, y = torch.rand(4, 1, 40, 56), torch.rand(4, 1, 40, 56)
+    band, separable = loss.SSIMEngine(), loss.SSIMEngine(band_limit=0)
+    for moment_band, moment_separable in zip(band.moments(x, y), separable.moments(x, y)):
+        assert torch.allclose(moment_band, moment_separable, atol=1e-6)
@@ -0,0 +1,89 @@
+import torch
+
+from models import modules
+from models.modules import fused_attention
+
+
+def reference_attention(q, k, v, attn_mask=None, scale=None):
+    att = torch.matmul(q, k.transpose(-2, -1)) * (q.shape[-1] ** -0.5 if scale is None else scale)
+    if attn_mask is not None:
+        att = att.masked_fill(attn_mask.logical_not(), float('-inf'))
+    return torch.matmul(torch.softmax(att, -1), v)
+
+
+def test_fused_attention_scale_and_mask():
+    torch.manual_seed(0)
+    q, k, v = torch.randn(2, 4, 10, 16), torch.randn(2, 4, 12, 16), torch.randn(2, 4, 12, 8)
+    attn_mask = torch.rand(10, 12) > 0.3
+    attn_mask[:, 0] = True
+    for scale in [None, 1., 0.1]:
+        for mask in [None, attn_mask]:
+            assert torch.allclose(fused_attention(q, k, v, attn_mask=mask, scale=scale), reference_attention(q, k, v, attn_mask=mask, scale=scale), atol=1e-5)
+
+
+def test_db_head_without_bn(monkeypatch):
+    # bb='vgg16' turns use_bn off.
+    monkeypatch.setattr(modules.config, 'use_bn', False)
+    db_head = modules.DBHead(8)
+    assert not any(isinstance(layer, torch.nn.BatchNorm2d) for layer in db_head.modules())
+    assert db_head(torch.randn(2, 8, 16, 16)).shape == (2, 1, 16, 16)
+
+
+def test_ref_unet_with_image():
+    # refine=4: image and coarse map in, refined map out.
+    ref_unet = modules.RefUnet(4, 64).eval()
+    with torch.no_grad():
+        assert ref_unet(torch.randn(2, 4, 32, 32)).shape == (2, 1, 32, 32)
+
+
+def test_gam_chunked_affinity():
+    # Tiles of fewer query positions than one image (30 < 7*7), and of several images (100), bit-for-bit against the full affinity.
+    torch.manual_seed(0)
+    gam = modules.GAM(64).eval()
+    x5 = torch.randn(5, 64, 7, 7)
+    with torch.no_grad():
+        for group_idx in [None, torch.tensor([0, 0, 0, 1, 1])]:
+            gam.chunk_size = 0
+            outputs_full = gam(x5, group_idx=group_idx)
+            for chunk_size in [30, 100]:
+                gam.chunk_size = chunk_size
+                assert torch.equal(gam(x5, group_idx=group_idx), outputs_full)
+
+
+def test_guided_upsample_range():
+    # A binary map with edges that do not follow the guide: the linear fit overshoots, clamp keeps it in [0, 1].
+    torch.manual_seed(0)
+    p = (torch.rand(2, 1, 16, 16) > 0.5).float()
+    guide = torch.rand(2, 1, 64, 64)
+    out = modules.guided_upsample(p, guide)
+    assert out.min() < 0 or out.max() > 1
+    out = modules.guided_upsample(p, guide, clamp=True)
+    assert out.shape == (2, 1, 64, 64)
+    assert out.min() >= 0 and out.max() <= 1
+
+
+def test_guided_output_stride_range():
+    from models.GCoNet_plus import GCoNet_plus
+    torch.manual_seed(0)
+    model = GCoNet_plus(bb_pretrained=False).eval()
+    model.config.output_stride, model.config.output_guided = 2, True
+    with torch.no_grad():
+        preds = model(torch.randn(2, 3, 64, 64))[-1]
+    assert preds.shape[2:] == (64, 64)
+    assert preds.min() >= 0 and preds.max() <= 1
+
+
+def test_gam_packed_groups():
+    # Packed groups (also interleaved) give what each group gives alone, in eager mode and in a traced graph.
+    torch.manual_seed(0)
+    gam = modules.GAM(64).eval()
+    x5 = torch.randn(5, 64, 7, 7)
+    with torch.no_grad():
+        for group_idx in [torch.tensor([0, 0, 1, 1, 1]), torch.tensor([1, 0, 1, 0, 1])]:
+            outputs_alone = torch.empty_like(x5)
+            for group in group_idx.unique():
+                images = (group_idx == group).nonzero().squeeze(1)
+                outputs_alone[images] = gam(x5[images])
+            assert torch.allclose(gam(x5, group_idx=group_idx), outputs_alone, atol=1e-6)
+            traced = torch.jit.trace(gam, (x5, torch.zeros(5, dtype=torch.long)), check_trace=False)
+            assert torch.allclose(traced(x5, group_idx), outputs_alone, atol=1e-6)
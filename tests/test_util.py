@@ -0,0 +1,43 @@
+import os
+import shutil
+
+import pytest
+import torch
+from torch import nn
+
+from export import InferenceWrapper
+from util import CompiledModule, MetricsWriter, unwrap_model
+
+
+class Tiny(nn.Module):
+    def __init__(self):
+        super(Tiny, self).__init__()
+        self.conv = nn.Conv2d(3, 1, 3, 1, 1)
+
+    def forward(self, x, group_idx=None):
+        return [self.conv(x)]
+
+
+def test_unwrap_model():
+    model = Tiny()
+    assert unwrap_model(model) is model
+    assert unwrap_model(CompiledModule(InferenceWrapper(model))) is model
+
+
+def test_compiled_module_mode_of_wrapped_model():
+    # The wrapper is left in train mode, the graphs are those of the model in eval mode.
+    compiled = CompiledModule(InferenceWrapper(Tiny().eval()))
+    with torch.no_grad():
+        compiled(torch.randn(2, 3, 16, 16))
+    assert list(compiled.graphs_first_forward) == ['eval']
+
+
+def test_metrics_writer_close_raises_write_error(tmp_path):
+    # The last rows are written on close(), a failing write must not be lost silently.
+    os.makedirs(str(tmp_path / 'run'))
+    path = str(tmp_path / 'run' / 'log_loss.csv')
+    writer = MetricsWriter(path, ['loss'])
+    writer.log(1, 8, 0.5, loss=torch.tensor(1.0))
+    shutil.rmtree(str(tmp_path / 'run'))
+    with pytest.raises(OSError):
+        writer.close()
@@ -3,14 +3,14 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.autograd import Variable
-from util import Logger, AverageMeter, save_checkpoint, save_tensor_img, set_seed
+from util import Logger, AverageMeter, AsyncCheckpointer, save_tensor_img, set_seed, rng_states, set_rng_states
 import os
 import numpy as np
 from matplotlib import pyplot as plt
 import time
 import argparse
 from tqdm import tqdm
-from dataset import get_loader
+from dataset import get_loader, DistributedGroupSampler
 import torchvision.utils as vutils
 
 import torch.nn.functional as F
@@ -18,7 +18,8 @@ import pytorch_toolbelt.losses as PTL
 
 from config import Config
 from loss import saliency_structure_consistency, DSLoss
-from util import generate_smoothed_gt
+from util import generate_smoothed_gt, CompiledModule, MetricsWriter
+from profiler import StageProfiler
 
 from evaluation.dataloader import EvalDataset
 from evaluation.evaluator import Eval_thread
@@ -35,7 +36,7 @@ parser.add_argument('--model',
 parser.add_argument('--resume',
                     default=None,
                     type=str,
-                    help='path to latest checkpoint')
+                    help='path to latest checkpoint, checkpoint.pth of ckpt_dir resumes the whole training state, other .pth only the weights')
 parser.add_argument('--epochs', default=30, type=int)
 parser.add_argument('--start_epoch',
                     default=0,
@@ -60,12 +61,39 @@ parser.add_argument('--val_dir',
                     default='tmp4val',
                     type=str,
                     help="Dir for saving tmp results for validation.")
+parser.add_argument('--device',
+                    default='cuda' if torch.cuda.is_available() else 'cpu',
+                    type=str,
+                    help="Options: 'cuda', 'cpu'")
+parser.add_argument('--compile', action='store_true', help='run the forward with torch.compile')
+parser.add_argument('--profile',
+                    default='',
+                    type=str,
+                    help="Profile the forward stages of the first --profile_iters iterations and save a Chrome trace here.")
+parser.add_argument('--profile_iters', default=20, type=int)
+parser.add_argument('--accum_steps', default=1, type=int,
+                    help='accumulate the gradients of this many iterations (group pairs) per optimizer step, for larger effective batches')
+parser.add_argument('--dist_backend', default='gloo', type=str, help="Options: 'gloo', 'nccl', for distributed training with torchrun")
+parser.add_argument('--sync_bn', action='store_true', help='distributed training: BatchNorm statistics over the groups of all ranks (CUDA only), e.g. for vgg16bn')
 
 args = parser.parse_args()
 
 
 config = Config()
 
+# Distributed training when launched by torchrun, e.g. `torchrun --nproc_per_node=2 train.py ...`: each rank trains on its own
+# share of the groups (DistributedGroupSampler) and the gradients are averaged. Only rank 0 logs, validates and saves.
+distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+if distributed:
+    import torch.distributed as dist
+    from torch.nn.parallel import DistributedDataParallel
+    dist.init_process_group(backend=args.dist_backend)
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+else:
+    rank, world_size = 0, 1
+is_main = rank == 0
+dist_kwargs = {'num_replicas': world_size, 'rank': rank, 'seed': config.rand_seed or 0} if distributed else {}
+
 # Prepare dataset
 if args.trainset == 'DUTS_class':
     root_dir = '/root/datasets/sod'
@@ -79,7 +107,8 @@ if args.trainset == 'DUTS_class':
                               istrain=True,
                               shuffle=False,
                               num_workers=8,
-                              pin=True)
+                              pin=True,
+                              **dist_kwargs)
     train_img_path_seg = os.path.join(root_dir, 'images/coco-seg')
     train_gt_path_seg = os.path.join(root_dir, 'gts/coco-seg')
     train_loader_seg = get_loader(
@@ -91,7 +120,8 @@ if args.trainset == 'DUTS_class':
         istrain=True,
         shuffle=True,
         num_workers=8,
-        pin=True
+        pin=True,
+        **dist_kwargs
     )
 else:
     print('Unkonwn train dataset')
@@ -101,7 +131,7 @@ test_loaders = {}
 for testset in args.testsets.split('+'):
     test_loader = get_loader(
         os.path.join('../../../datasets/sod', 'images', testset), os.path.join('../../../datasets/sod', 'gts', testset),
-        args.size, 1, istrain=False, shuffle=False, num_workers=8, pin=True
+        args.size, 1, istrain=False, shuffle=False, num_workers=8, pin=True, max_batch=config.batch_size
     )
     test_loaders[testset] = test_loader
 
@@ -112,20 +142,35 @@ if config.rand_seed:
 os.makedirs(args.ckpt_dir, exist_ok=True)
 
 # Init log file
-logger = Logger(os.path.join(args.ckpt_dir, "log.txt"))
-logger_loss_file = os.path.join(args.ckpt_dir, "log_loss.txt")
+logger = Logger(os.path.join(args.ckpt_dir, "log.txt"), quiet=not is_main, append=bool(args.resume))
+logger_loss_file = os.path.join(args.ckpt_dir, "log_loss.csv")
 logger_loss_idx = 1
+# Per-step losses (summed over the two halves of an iteration, triplet is also part of sal) and throughput.
+metrics_writer = MetricsWriter(
+    logger_loss_file, ['loss', 'sal', 'triplet', 'cls', 'contrast', 'cls_mask', 'adv'], append=bool(args.resume)
+) if is_main else None
 
 # Init model
-device = torch.device("cuda")
+device = torch.device(args.device)
+if distributed and device.type == 'cuda':
+    device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+    torch.cuda.set_device(device)
 
 model = GCoNet_plus()
+if args.sync_bn:
+    if not distributed or device.type != 'cuda':
+        raise ValueError('--sync_bn needs distributed training on CUDA.')
+    model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
 model = model.to(device)
 if config.lambda_adv:
     from adv import Discriminator
     disc = Discriminator(channels=1, img_size=args.size).to(device)
+    if distributed:
+        # disc is not wrapped in DistributedDataParallel, start from the weights of rank 0 and average its gradients by hand.
+        for value in disc.state_dict().values():
+            dist.broadcast(value, 0)
     optimizer_d = optim.Adam(params=disc.parameters(), lr=config.lr, betas=[0.9, 0.99])
-    Tensor = torch.cuda.FloatTensor if (True if torch.cuda.is_available() else False) else torch.FloatTensor
+    Tensor = torch.cuda.FloatTensor if device.type == 'cuda' else torch.FloatTensor
     adv_criterion = nn.BCELoss()
 
 backbone_params = list(map(id, model.bb.parameters()))
@@ -144,6 +189,18 @@ if config.freeze:
         if 'bb' in key and 'bb.conv5.conv5_3' not in key:
             value.requires_grad = False
 
+if distributed:
+    # After freezing, DistributedDataParallel only syncs the parameters that require grad. Some built modules are unused
+    # depending on the config. Without SyncBN each group is still normalized with its own statistics on its rank,
+    # the running stats are those of rank 0 (broadcast_buffers).
+    ddp_model = DistributedDataParallel(
+        model, device_ids=[device.index] if device.type == 'cuda' else None, find_unused_parameters=True
+    )
+else:
+    ddp_model = model
+# Compiled forward, shares the parameters of model which is still the one optimized and saved.
+forward_model = CompiledModule(ddp_model) if args.compile else ddp_model
+
 
 # log model and optimizer params
 logger.info("Model details:")
@@ -159,47 +216,91 @@ logger.info(args)
 dsloss = DSLoss()
 
 
+def training_state(epoch, val_measures):
+    # Everything needed to resume training after epoch, see resume().
+    state = {
+        'epoch': epoch + 1,
+        'state_dict': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'logger_loss_idx': logger_loss_idx,
+        'val_measures': val_measures,
+        'rng': rng_states(),
+    }
+    if config.lambda_adv:
+        state['disc'] = disc.state_dict()
+        state['optimizer_d'] = optimizer_d.state_dict()
+    return state
+
+
+def resume(path):
+    # Returns the validation history, args.start_epoch is set to the epoch to continue from.
+    global logger_loss_idx
+    logger.info("=> loading checkpoint '{}'".format(path))
+    # A checkpoint written by training_state, not only tensors.
+    checkpoint = torch.load(path, map_location=device, weights_only=False)
+    if 'state_dict' not in checkpoint:
+        # Model weights only, e.g. ep{N}.pth or best_*.pth.
+        model.load_state_dict(checkpoint)
+        return []
+    model.load_state_dict(checkpoint['state_dict'])
+    scheduler.load_state_dict(checkpoint['scheduler'])
+    args.start_epoch = checkpoint['epoch']
+    # Checkpoints saved before the full training state have no more than that.
+    if 'optimizer' in checkpoint:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        logger_loss_idx = checkpoint['logger_loss_idx']
+        set_rng_states(checkpoint['rng'])
+        if config.lambda_adv:
+            disc.load_state_dict(checkpoint['disc'])
+            optimizer_d.load_state_dict(checkpoint['optimizer_d'])
+    logger.info("=> loaded checkpoint '{}' (epoch {})".format(path, checkpoint['epoch']))
+    return checkpoint.get('val_measures', [])
+
+
 def main():
     val_measures = []
 
     # Optionally resume from a checkpoint
     if args.resume:
         if os.path.isfile(args.resume):
-            logger.info("=> loading checkpoint '{}'".format(args.resume))
-            # checkpoint = torch.load(args.resume)
-            # args.start_epoch = checkpoint['epoch']
-            model.load_state_dict(torch.load(args.resume))
-            # optimizer.load_state_dict(checkpoint['optimizer'])
-            # scheduler.load_state_dict(checkpoint['scheduler'])
-            # logger.info("=> loaded checkpoint '{}' (epoch {})".format(
-            #     args.resume, checkpoint['epoch']))
+            val_measures = resume(args.resume)
         else:
             logger.info("=> no checkpoint found at '{}'".format(args.resume))
 
+    # Checkpoints are written in the background from CPU copies, by rank 0.
+    checkpointer = AsyncCheckpointer(args.ckpt_dir) if is_main else None
     for epoch in range(args.start_epoch, args.epochs):
+        for loader in [train_loader, train_loader_seg]:
+            if isinstance(loader.sampler, DistributedGroupSampler):
+                loader.sampler.set_epoch(epoch)
         train_loss = train(epoch)
-        if config.validation:
-            measures = validate(model, test_loaders, args.testsets)
-            val_measures.append(measures)
-            print('Validation: S_measure on CoCA for epoch-{} is {:.4f}. Best epoch is epoch-{} with S_measure {:.4f}'.format(
-                epoch, measures[0], np.argmax(np.array(val_measures)[:, 0].squeeze()), np.max(np.array(val_measures)[:, 0]))
-            )
-        # Save checkpoint
-        save_checkpoint(
-            {
-                'epoch': epoch + 1,
-                'state_dict': model.state_dict(),
-                'scheduler': scheduler.state_dict(),
-            },
-            path=args.ckpt_dir)
-        if epoch >= args.epochs - config.val_last:
-            torch.save(model.state_dict(), os.path.join(args.ckpt_dir, 'ep{}.pth'.format(epoch)))
-        if config.validation:
-            if np.max(np.array(val_measures)[:, 0].squeeze()) == measures[0]:
-                best_weights_before = [os.path.join(args.ckpt_dir, weight_file) for weight_file in os.listdir(args.ckpt_dir) if 'best_' in weight_file]
-                for best_weight_before in best_weights_before:
-                    os.remove(best_weight_before)
-                torch.save(model.state_dict(), os.path.join(args.ckpt_dir, 'best_ep{}_Smeasure{:.4f}.pth'.format(epoch, measures[0])))
+        if is_main:
+            if config.validation:
+                # The plain model on rank 0, a forward of the DistributedDataParallel one would wait for the other ranks.
+                measures = validate(model if distributed else forward_model, test_loaders, args.testsets)
+                val_measures.append(measures)
+                print('Validation: S_measure on CoCA for epoch-{} is {:.4f}. Best epoch is epoch-{} with S_measure {:.4f}'.format(
+                    epoch, measures[0], np.argmax(np.array(val_measures)[:, 0].squeeze()), np.max(np.array(val_measures)[:, 0]))
+                )
+            # Save checkpoint
+            checkpointer.save(training_state(epoch, val_measures), 'checkpoint.pth')
+            if epoch >= args.epochs - config.val_last:
+                checkpointer.save(model.state_dict(), 'ep{}.pth'.format(epoch), rotate=('ep', config.val_last))
+            if config.validation:
+                if np.max(np.array(val_measures)[:, 0].squeeze()) == measures[0]:
+                    # The previous best is removed once this one is written.
+                    checkpointer.save(
+                        model.state_dict(), 'best_ep{}_Smeasure{:.4f}.pth'.format(epoch, measures[0]), rotate=('best_ep', 1)
+                    )
+        if distributed:
+            dist.barrier()
+    if checkpointer is not None:
+        checkpointer.close()
+    if metrics_writer is not None:
+        metrics_writer.close()
+    if distributed:
+        dist.destroy_process_group()
 
 def train(epoch):
     loss_log = AverageMeter()
@@ -207,15 +308,33 @@ def train(epoch):
     global logger_loss_idx
     model.train()
     FL = PTL.BinaryFocalLoss()
-
+    profiler = None
+    if args.profile and epoch == args.start_epoch and is_main:
+        profiler = StageProfiler(model)
+        profiler.attach()
+
+    # Gradients are accumulated over args.accum_steps iterations (a shorter last window at the end of the epoch),
+    # each iteration's loss is divided by its window size so that an update is the mean over the window.
+    num_iters = min(len(train_loader), len(train_loader_seg))
+    optimizer.zero_grad()
     for batch_idx, (batch, batch_seg) in enumerate(zip(train_loader, train_loader_seg)):
+        window_start = batch_idx - batch_idx % args.accum_steps
+        window_size = min(args.accum_steps, num_iters - window_start)
+        update = batch_idx == window_start + window_size - 1
+        time_st = time.perf_counter()
+        step_losses = {}
+        if distributed:
+            # As DistributedDataParallel.no_sync() around the iteration: all-reduce the gradients only before an update.
+            ddp_model.require_backward_grad_sync = update
+        if profiler is not None and batch_idx == args.profile_iters:
+            profiler = finish_profile(profiler)
         inputs = batch[0].to(device).squeeze(0)
         gts = batch[1].to(device).squeeze(0)
         cls_gts = torch.LongTensor(batch[-1]).to(device)
         
         gts_neg = torch.full_like(gts, 0.0)
         gts_cat = torch.cat([gts, gts_neg], dim=0)
-        return_values = model(inputs)
+        return_values = forward_model(inputs)
         if {'sal', 'cls', 'contrast', 'cls_mask'} == set(config.loss):
             scaled_preds, pred_cls, pred_contrast, pred_cls_masks = return_values[:4]
         elif {'sal', 'cls', 'contrast'} == set(config.loss):
@@ -245,7 +364,7 @@ def train(epoch):
         if config.self_supervision:
             H, W = inputs.shape[-2:]
             images_scale = F.interpolate(inputs, size=(H//4, W//4), mode='bilinear', align_corners=True)
-            sal_scale = model(images_scale)[0][-1]
+            sal_scale = forward_model(images_scale)[0][-1]
             atts = scaled_preds[-1]
             sal_s = F.interpolate(atts, size=(H//4, W//4), mode='bilinear', align_corners=True)
             loss_ss = saliency_structure_consistency(sal_scale.sigmoid(), sal_s.sigmoid())
@@ -256,26 +375,33 @@ def train(epoch):
         # since there may be several losses for sal, the lambdas for them (lambdas_sal) are inside the loss.py
         loss_sal = loss_sal * 1
         loss += loss_sal
+        add_loss(step_losses, 'sal', loss_sal)
+        if config.lambdas_sal_last['triplet']:
+            add_loss(step_losses, 'triplet', loss_triplet)
         if 'cls' in config.loss:
             loss_cls = F.cross_entropy(pred_cls, cls_gts) * config.lambda_cls
             loss += loss_cls
+            add_loss(step_losses, 'cls', loss_cls)
         if 'contrast' in config.loss:
             loss_contrast = FL(pred_contrast, gts_cat) * config.lambda_contrast
             loss += loss_contrast
+            add_loss(step_losses, 'contrast', loss_contrast)
         if 'cls_mask' in config.loss:
             loss_cls_mask = 0
             for pred_cls_mask in pred_cls_masks:
                 loss_cls_mask += F.cross_entropy(pred_cls_mask, cls_gts) * config.lambda_cls_mask
             loss += loss_cls_mask
+            add_loss(step_losses, 'cls_mask', loss_cls_mask)
         if config.lambda_adv:
             # gen
             valid = Variable(Tensor(scaled_preds[-1].shape[0], 1).fill_(1.0), requires_grad=False)
             adv_loss_g = adv_criterion(disc(scaled_preds[-1]), valid)
             loss += adv_loss_g * config.lambda_adv
+            add_loss(step_losses, 'adv', adv_loss_g * config.lambda_adv)
 
-        loss_log.update(loss, inputs.size(0))
+        loss_log.update(loss.detach(), inputs.size(0))
         if config.lambdas_sal_last['triplet']:
-            loss_log_triplet.update(loss_triplet, inputs.size(0))
+            loss_log_triplet.update(loss_triplet.detach(), inputs.size(0))
 
         # optimizer.zero_grad()
         # loss.backward()
@@ -288,7 +414,7 @@ def train(epoch):
 
         gts_neg = torch.full_like(gts, 0.0)
         gts_cat = torch.cat([gts, gts_neg], dim=0)
-        return_values = model(inputs)
+        return_values = forward_model(inputs)
         if {'sal', 'cls', 'contrast', 'cls_mask'} == set(config.loss):
             scaled_preds, pred_cls, pred_contrast, pred_cls_masks = return_values[:4]
         elif {'sal', 'cls', 'contrast'} == set(config.loss):
@@ -318,7 +444,7 @@ def train(epoch):
         if config.self_supervision:
             H, W = inputs.shape[-2:]
             images_scale = F.interpolate(inputs, size=(H//4, W//4), mode='bilinear', align_corners=True)
-            sal_scale = model(images_scale)[0][-1]
+            sal_scale = forward_model(images_scale)[0][-1]
             atts = scaled_preds[-1]
             sal_s = F.interpolate(atts, size=(H//4, W//4), mode='bilinear', align_corners=True)
             loss_ss = saliency_structure_consistency(sal_scale.sigmoid(), sal_s.sigmoid())
@@ -329,33 +455,42 @@ def train(epoch):
         # since there may be several losses for sal, the lambdas for them (lambdas_sal) are inside the loss.py
         loss_sal = loss_sal * 1
         loss += loss_sal
+        add_loss(step_losses, 'sal', loss_sal)
+        if config.lambdas_sal_last['triplet']:
+            add_loss(step_losses, 'triplet', loss_triplet)
         if 'cls' in config.loss:
             loss_cls = F.cross_entropy(pred_cls, cls_gts) * config.lambda_cls
             loss += loss_cls
+            add_loss(step_losses, 'cls', loss_cls)
         if 'contrast' in config.loss:
             loss_contrast = FL(pred_contrast, gts_cat) * config.lambda_contrast
             loss += loss_contrast
+            add_loss(step_losses, 'contrast', loss_contrast)
         if 'cls_mask' in config.loss:
             loss_cls_mask = 0
             for pred_cls_mask in pred_cls_masks:
                 loss_cls_mask += F.cross_entropy(pred_cls_mask, cls_gts) * config.lambda_cls_mask
             loss += loss_cls_mask
+            add_loss(step_losses, 'cls_mask', loss_cls_mask)
         if config.lambda_adv:
             # gen
             valid = Variable(Tensor(scaled_preds[-1].shape[0], 1).fill_(1.0), requires_grad=False)
             adv_loss_g = adv_criterion(disc(scaled_preds[-1]), valid)
             loss += adv_loss_g * config.lambda_adv
+            add_loss(step_losses, 'adv', adv_loss_g * config.lambda_adv)
 
-        loss_log.update(loss, inputs.size(0))
+        loss_log.update(loss.detach(), inputs.size(0))
         if config.lambdas_sal_last['triplet']:
-            loss_log_triplet.update(loss_triplet, inputs.size(0))
-        with open(logger_loss_file, 'a') as f:
-            f.write('step {}, {}\n'.format(logger_loss_idx, loss))
+            loss_log_triplet.update(loss_triplet.detach(), inputs.size(0))
+        (loss / window_size).backward()
+        if update:
+            optimizer.step()
+            optimizer.zero_grad()
+        if is_main:
+            metrics_writer.log(
+                logger_loss_idx, batch[0].shape[1] + batch_seg[0].shape[1], time.perf_counter() - time_st, loss=loss, **step_losses
+            )
         logger_loss_idx += 1
-
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
         #<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
 
         if config.lambda_adv and batch_idx % 5 == 0:
@@ -366,6 +501,8 @@ def train(epoch):
             adv_loss_fake = adv_criterion(disc(scaled_preds[-1].detach()), fake)
             adv_loss_d = (adv_loss_real + adv_loss_fake) / 2 * 1.
             adv_loss_d.backward()
+            if distributed:
+                average_gradients(disc)
             optimizer_d.step()
 
         # Logger
@@ -385,15 +522,46 @@ def train(epoch):
                 info_loss += ', loss_triplet: {:.3f}'.format(loss_triplet)
             info_loss += ', Loss_total: {loss.val:.3f} ({loss.avg:.3f})  '.format(loss=loss_log)
             logger.info(''.join((info_progress, info_loss)))
+    if profiler is not None:
+        profiler = finish_profile(profiler)
+    if is_main:
+        metrics_writer.flush()
     scheduler.step()
+    if distributed:
+        # Mean over the ranks, each one saw its own share of the groups.
+        loss_avg = torch.as_tensor(loss_log.avg, dtype=torch.float, device=device).detach().clone()
+        dist.all_reduce(loss_avg)
+        loss_log.avg = loss_avg.item() / world_size
     info_loss = '@==Final== Epoch[{0}/{1}]  Train Loss: {loss.avg:.3f}  '.format(epoch, args.epochs, loss=loss_log)
     if config.lambdas_sal_last['triplet']:
         info_loss += 'Triplet Loss: {loss.avg:.3f}  '.format(loss=loss_log_triplet)
     logger.info(info_loss)
+    if args.compile:
+        logger.info(forward_model.report())
 
     return loss_log.avg
 
 
+def add_loss(step_losses, name, value):
+    step_losses[name] = step_losses.get(name, 0) + value.detach()
+
+
+def average_gradients(module):
+    # For modules outside DistributedDataParallel, same mean over the ranks as its gradient all-reduce.
+    for param in module.parameters():
+        if param.grad is not None:
+            dist.all_reduce(param.grad)
+            param.grad /= world_size
+
+
+def finish_profile(profiler):
+    profiler.detach()
+    logger.info('Profile of {} forwards:\n{}'.format(len(profiler.forwards), profiler.summary()))
+    profiler.export_chrome_trace(args.profile)
+    logger.info('Saved the Chrome trace to {}.'.format(args.profile))
+    return None
+
+
 def validate(model, test_loaders, testsets):
     model.eval()
 
@@ -406,19 +574,20 @@ def validate(model, test_loaders, testsets):
         saved_root = os.path.join(args.val_dir, testset)
 
         for batch in test_loader:
-            inputs = batch[0].to(device).squeeze(0)
-            gts = batch[1].to(device).squeeze(0)
+            inputs = batch[0].to(device)
             subpaths = batch[2]
             ori_sizes = batch[3]
+            group_idx = batch[4].to(device)
             with torch.no_grad():
-                scaled_preds = model(inputs)[-1]
+                scaled_preds = model(inputs, group_idx=group_idx)[-1]
 
-            os.makedirs(os.path.join(saved_root, subpaths[0][0].split('/')[0]), exist_ok=True)
+            for subpath in subpaths:
+                os.makedirs(os.path.join(saved_root, subpath.split('/')[0]), exist_ok=True)
 
             num = len(scaled_preds)
             for inum in range(num):
-                subpath = subpaths[inum][0]
-                ori_size = (ori_sizes[inum][0].item(), ori_sizes[inum][1].item())
+                subpath = subpaths[inum]
+                ori_size = ori_sizes[inum]
                 if config.db_output_refiner or (not config.refine and config.db_output_decoder):
                     res = nn.functional.interpolate(scaled_preds[inum].unsqueeze(0), size=ori_size, mode='bilinear', align_corners=True)
                 else:
@@ -429,7 +598,7 @@ def validate(model, test_loaders, testsets):
             saved_root,                                                             # preds
             os.path.join('/root/datasets/sod/gts', testset)                     # GT
         )
-        evaler = Eval_thread(eval_loader, cuda=True)
+        evaler = Eval_thread(eval_loader, cuda=device.type == 'cuda')
         # Use S_measure for validation
         s_measure = evaler.Eval_Smeasure()
         if s_measure > config.val_measures['Smeasure']['CoCA'] and 0:
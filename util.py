@@ -1,8 +1,13 @@
 import logging
 import os
+import re
+import copy
+import queue
+import threading
 import torch
 import shutil
 from torchvision import transforms
+from PIL import Image
 import numpy as np
 import random
 import cv2
@@ -15,9 +20,15 @@ def generate_smoothed_gt(gts):
 
 
 class Logger():
-    def __init__(self, path="log.txt"):
+    def __init__(self, path="log.txt", quiet=False, append=False):
         self.logger = logging.getLogger('DGNet')
-        self.file_handler = logging.FileHandler(path, "w")
+        if quiet:
+            # e.g. the ranks other than 0 in distributed training, nothing is written.
+            self.logger.disabled = True
+            self.file_handler = logging.NullHandler()
+            self.stdout_handler = logging.NullHandler()
+            return
+        self.file_handler = logging.FileHandler(path, "a" if append else "w")
         self.stdout_handler = logging.StreamHandler()
         self.stdout_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
         self.file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
@@ -52,7 +63,96 @@ class AverageMeter(object):
 
 
 def save_checkpoint(state, path, filename="checkpoint.pth"):
-    torch.save(state, os.path.join(path, filename))
+    # Atomic: written next to the target first, so a crash never leaves a truncated checkpoint behind.
+    path_tmp = os.path.join(path, '.{}.tmp'.format(filename))
+    torch.save(state, path_tmp)
+    os.replace(path_tmp, os.path.join(path, filename))
+
+
+def cpu_copy(state):
+    # Copy of the tensors of a (nested) state on CPU, later updates of the originals do not change it.
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, cpu_copy(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_copy(value) for value in state)
+    return copy.deepcopy(state)
+
+
+def rng_states():
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'numpy': np.random.get_state(),
+        'random': random.getstate(),
+    }
+
+
+def set_rng_states(states):
+    torch.set_rng_state(states['torch'])
+    if states['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['random'])
+
+
+class AsyncCheckpointer():
+    """
+    Saves checkpoints in path from a background thread, so that training does not wait for the disk.
+    save() only takes a CPU copy of the state on the calling thread, the writes (atomic, see save_checkpoint)
+    happen in order in the thread. At most max_pending copies wait to be written, save() blocks beyond that.
+    With rotate=(prefix, keep), once written only the keep latest files '<prefix><N>...pth' by N are kept.
+    Errors of the thread are raised by the next save(), wait() or close().
+    """
+    def __init__(self, path, max_pending=2):
+        self.path = path
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, filename, rotate=None):
+        self._raise()
+        self.queue.put((cpu_copy(state), filename, rotate))
+
+    def wait(self):
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                state, filename, rotate = job
+                save_checkpoint(state, self.path, filename)
+                if rotate is not None:
+                    self._rotate(*rotate)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _rotate(self, prefix, keep):
+        numbered = []
+        for filename in os.listdir(self.path):
+            number = re.match(re.escape(prefix) + r'(\d+).*\.pth$', filename)
+            if number:
+                numbered.append((int(number.group(1)), filename))
+        for _, filename in sorted(numbered)[:-keep]:
+            os.remove(os.path.join(self.path, filename))
 
 
 def save_tensor_img(tenor_im, path):
@@ -63,6 +163,62 @@ def save_tensor_img(tenor_im, path):
     im.save(path)
 
 
+def save_pred_map(pred_map, path, compress_level=6):
+    # uint8 H x W numpy map to a grayscale PNG, compress_level 0 (fastest) to 9 (smallest), 6 is the PIL default.
+    Image.fromarray(pred_map).save(path, compress_level=compress_level)
+
+
+class PredictionWriter():
+    """
+    Encodes and writes uint8 prediction maps as PNG files with num_workers threads (PIL releases the GIL
+    while encoding), so that the model does not wait for the disk. write() only queues the map, and blocks
+    when max_pending maps are already waiting (backpressure). With num_workers=0 write() saves right away.
+    Errors of the threads are raised by the next write(), wait() or close().
+    """
+    def __init__(self, num_workers=4, max_pending=64, compress_level=6):
+        self.compress_level = compress_level
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, pred_map, path):
+        self._raise()
+        if self.threads:
+            self.queue.put((pred_map, path))
+        else:
+            save_pred_map(pred_map, path, self.compress_level)
+
+    def wait(self):
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                save_pred_map(*job, compress_level=self.compress_level)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
 def save_tensor_merge(tenor_im, tensor_mask, path, colormap='HOT'):
     im = tenor_im.cpu().detach().clone()
     im = im.squeeze(0).numpy()
@@ -95,3 +251,117 @@ def set_seed(seed):
      torch.backends.cudnn.deterministic = True
 
 
+class MetricsWriter():
+    """
+    Per-step training metrics in a CSV file (step, images, step_time, images_per_s and the given names) without a device
+    sync per step. log() only keeps the detached scalars, on their device. Every flush_every steps they are stacked and
+    copied to the host at once, and a background thread appends the rows to the file. Missing values are written as nan.
+    step_time is measured by the caller on the host, on CUDA it is only exact on average over many steps.
+    """
+    def __init__(self, path, names, flush_every=100, append=False):
+        self.path = path
+        self.names = list(names)
+        self.flush_every = flush_every
+        self.rows = []
+        self.queue = queue.Queue()
+        self.error = None
+        if not (append and os.path.isfile(path)):
+            with open(path, 'w') as f:
+                f.write(','.join(['step', 'images', 'step_time', 'images_per_s'] + self.names) + '\n')
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log(self, step, images, step_time, **values):
+        device = next((value.device for value in values.values() if torch.is_tensor(value)), torch.device('cpu'))
+        row = torch.stack([
+            values[name].detach().float().reshape(()).to(device) if torch.is_tensor(values.get(name))
+            else torch.full((), float(values.get(name, float('nan'))), device=device)
+            for name in self.names
+        ])
+        self.rows.append(((step, images, step_time), row))
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self._raise()
+        if self.rows:
+            host_values = [host for host, _ in self.rows]
+            self.queue.put((host_values, torch.stack([row for _, row in self.rows]).cpu()))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            host_values, values = job
+            try:
+                with open(self.path, 'a') as f:
+                    for (step, images, step_time), row in zip(host_values, values.tolist()):
+                        f.write(','.join(['{}'.format(step), '{}'.format(images), '{:.4f}'.format(step_time), '{:.2f}'.format(images / max(step_time, 1e-12))]
+                                         + ['{:.6g}'.format(value) for value in row]) + '\n')
+            except Exception as e:
+                self.error = e
+
+
+def unwrap_model(model):
+    # The model inside CompiledModule, DistributedDataParallel (.module) and InferenceWrapper (.model).
+    while True:
+        inner = getattr(model, 'module', None)
+        if not isinstance(inner, torch.nn.Module):
+            inner = getattr(model, 'model', None)
+        if not isinstance(inner, torch.nn.Module):
+            return model
+        model = inner
+
+
+class CompiledModule(torch.nn.Module):
+    """
+    torch.compile of a model for training or inference. The first dim of every tensor input (number of images,
+    group_idx) is marked dynamic, so new group sizes reuse the compiled graphs instead of recompiling.
+    Counts the graphs compiled: several in the first forward of a mode (train/eval) mean graph breaks,
+    any in later forwards are recompiles, see report().
+    """
+    def __init__(self, model, **compile_kwargs):
+        super(CompiledModule, self).__init__()
+        from torch._inductor.compile_fx import compile_fx
+        self.model = model
+        self.graphs_first_forward = {}
+        self.recompiles = 0
+        self.graphs_compiled = 0
+
+        def backend(gm, example_inputs):
+            self.graphs_compiled += 1
+            return compile_fx(gm, example_inputs)
+        # Not registered as a submodule, its parameters are those of self.model.
+        self.__dict__['compiled'] = torch.compile(model, backend=backend, **compile_kwargs)
+
+    def forward(self, *args, **kwargs):
+        for tensor in list(args) + list(kwargs.values()):
+            if torch.is_tensor(tensor) and tensor.dim():
+                torch._dynamo.maybe_mark_dynamic(tensor, 0)
+        graphs_before = self.graphs_compiled
+        outputs = self.compiled(*args, **kwargs)
+        # From the wrapped model, the wrappers (DDP, InferenceWrapper) may not follow its train/eval mode.
+        mode = 'train' if unwrap_model(self.model).training else 'eval'
+        if mode not in self.graphs_first_forward:
+            self.graphs_first_forward[mode] = self.graphs_compiled - graphs_before
+        else:
+            self.recompiles += self.graphs_compiled - graphs_before
+        return outputs
+
+    def report(self):
+        return 'torch.compile: {}, {} recompiles.'.format(', '.join(
+            '{} graphs in {} ({} graph breaks)'.format(num_graphs, mode, max(num_graphs - 1, 0)) for mode, num_graphs in self.graphs_first_forward.items()
+        ), self.recompiles)